@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from snakemake_staging.config import configure as configure
+from snakemake_staging.git import GitStage as GitStage
 from snakemake_staging.rules import snakefile as snakefile
 from snakemake_staging.stages import (
     NoOpStage as NoOpStage,
@@ -0,0 +1,4 @@
+from snakemake_staging.cli import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import argparse
+from typing import Any, Dict, List, Optional
+
+from snakemake_staging.utils import cwd
+
+
+def parse_config(entries: Optional[List[str]]) -> Dict[str, Any]:
+    # Use Snakemake's own parser so that "--config" behaves the same here as it
+    # does on the snakemake command line
+    from snakemake.cli import parse_config as _parse_config
+
+    return dict(_parse_config(entries or []))
+
+
+def _add_workflow_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "-s",
+        "--snakefile",
+        default="Snakefile",
+        help="The Snakefile defining the stages (default: Snakefile)",
+    )
+    parser.add_argument(
+        "-d",
+        "--directory",
+        default=".",
+        help="The working directory for the workflow (default: .)",
+    )
+    parser.add_argument(
+        "-C",
+        "--config",
+        nargs="*",
+        metavar="KEY=VALUE",
+        help="Set or overwrite values in the workflow config object",
+    )
+
+
+def plan(args: argparse.Namespace) -> None:
+    from snakemake_staging.plan import (
+        format_plan,
+        plan as _plan,
+    )
+    from snakemake_staging.stages import load_stages
+
+    with cwd(args.directory):
+        stages = load_stages(args.snakefile, config=parse_config(args.config))
+        plans = _plan(stages.values(), throughput=args.throughput)
+    print(format_plan(plans, as_json=args.json))
+
+
+def restore(args: argparse.Namespace) -> None:
+    from snakemake_staging.restore import restore as _restore
+    from snakemake_staging.stages import STAGES, Stage, load_stages
+    from snakemake_staging.zenodo import ZenodoStage
+
+    stages: List[Stage]
+    with cwd(args.directory):
+        if args.info_file:
+            STAGES.clear()
+            stages = [ZenodoStage.from_info_file(f) for f in args.info_file]
+        else:
+            config = parse_config(args.config)
+            stages = list(load_stages(args.snakefile, config=config).values())
+        if not any(stage.restore for stage in stages):
+            raise SystemExit(
+                "No stages are configured to restore; did you forget "
+                "'--config restore=True'?"
+            )
+        restored = _restore(
+            stages, jobs=args.jobs, force=args.force, progress=not args.quiet
+        )
+    if not args.quiet:
+        print(f"Restored {len(restored)} files")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="snakemake-staging")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = subparsers.add_parser(
+        "plan",
+        help="Estimate the volume and duration of transfers for each stage",
+    )
+    _add_workflow_arguments(plan_parser)
+    plan_parser.add_argument(
+        "--throughput",
+        type=float,
+        default=None,
+        help="Assume this throughput in bytes per second instead of using the "
+        "throughput measured on previous runs",
+    )
+    plan_parser.add_argument(
+        "--json", action="store_true", help="Output the plan as JSON"
+    )
+    plan_parser.set_defaults(func=plan)
+
+    restore_parser = subparsers.add_parser(
+        "restore",
+        help="Restore all staged files up front, outside of Snakemake",
+    )
+    _add_workflow_arguments(restore_parser)
+    restore_parser.add_argument(
+        "-i",
+        "--info-file",
+        action="append",
+        help="Restore the Zenodo record described by this info file instead of "
+        "loading stages from the Snakefile (can be repeated)",
+    )
+    restore_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="The number of files to restore concurrently (default: 8)",
+    )
+    restore_parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Restore files even if they already exist",
+    )
+    restore_parser.add_argument(
+        "-q", "--quiet", action="store_true", help="Don't show progress"
+    )
+    restore_parser.set_defaults(func=restore)
+
+    args = parser.parse_args(argv)
+    args.func(args)
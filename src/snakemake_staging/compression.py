@@ -0,0 +1,126 @@
+import hashlib
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, Optional, Type
+
+from snakemake_staging.utils import PathLike
+
+CHUNK_SIZE = 1 << 20
+
+
+class Codec(ABC):
+    name: str
+    suffix: str
+
+    @abstractmethod
+    def compressobj(self) -> Any:
+        ...
+
+    @abstractmethod
+    def decompressobj(self) -> Any:
+        ...
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    suffix = ".zst"
+
+    def __init__(self, level: int = 3):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "The 'zstandard' package is required for zstd compression; "
+                "install it with 'pip install snakemake-staging[zstd]'"
+            ) from e
+        self._zstandard = zstandard
+        self.level = level
+
+    def compressobj(self) -> Any:
+        return self._zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompressobj(self) -> Any:
+        return self._zstandard.ZstdDecompressor().decompressobj()
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    suffix = ".gz"
+
+    def __init__(self, level: int = 1):
+        self.level = level
+
+    def compressobj(self) -> Any:
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def decompressobj(self) -> Any:
+        return zlib.decompressobj(31)
+
+
+CODECS: Dict[str, Type[Codec]] = {"zstd": ZstdCodec, "gzip": GzipCodec}
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise ValueError(
+            f"Unknown compression codec '{name}'; expected one of "
+            f"{', '.join(CODECS.keys())}"
+        )
+    return CODECS[name]()
+
+
+def sample_ratio(
+    path: PathLike, codec: Codec, sample_size: int = 1 << 16
+) -> Optional[float]:
+    # The compression ratio for a sample from the start of the file, or None if
+    # the file is empty
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+    if not sample:
+        return None
+    compressor = codec.compressobj()
+    compressed = compressor.compress(sample) + compressor.flush()
+    return len(compressed) / len(sample)
+
+
+def is_compressible(
+    path: PathLike,
+    codec: Codec,
+    sample_size: int = 1 << 16,
+    threshold: float = 0.9,
+) -> bool:
+    # Compress a sample from the start of the file and only compress the full
+    # file if this saves a meaningful amount of space. This catches files that
+    # are already compressed (images, archives, etc.) cheaply.
+    ratio = sample_ratio(path, codec, sample_size=sample_size)
+    return ratio is not None and ratio < threshold
+
+
+def estimate_compressed_size(
+    path: PathLike,
+    codec: Codec,
+    sample_size: int = 1 << 16,
+    threshold: float = 0.9,
+) -> int:
+    # The expected number of bytes uploaded for this file, assuming that the
+    # whole file compresses as well as the sample used by is_compressible
+    size = Path(path).stat().st_size
+    ratio = sample_ratio(path, codec, sample_size=sample_size)
+    if ratio is None or ratio >= threshold:
+        return size
+    return int(size * ratio)
+
+
+def compress_file(src: PathLike, dst: PathLike, codec: Codec) -> str:
+    # Stream the compressed contents of src into dst, returning the MD5
+    # checksum of the uncompressed data for verification on restore
+    checksum = hashlib.md5()
+    compressor = codec.compressobj()
+    Path(dst).parent.mkdir(parents=True, exist_ok=True)
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b""):
+            checksum.update(chunk)
+            fout.write(compressor.compress(chunk))
+        fout.write(compressor.flush())
+    return checksum.hexdigest()
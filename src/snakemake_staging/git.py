@@ -0,0 +1,363 @@
+import json
+import os
+import shutil
+import subprocess
+import time
+from functools import cached_property
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from snakemake_staging.stages import Stage, TransferResult
+from snakemake_staging.utils import (
+    PathLike,
+    copy_file_or_directory,
+    file_size,
+    is_up_to_date,
+    package_data,
+    path_to_identifier,
+)
+from snakemake_staging.version import __version__
+
+
+class GitStage(Stage):
+    def __init__(
+        self,
+        name: str,
+        restore: bool,
+        url: str,
+        branch: str = "main",
+        prefix: Optional[str] = None,
+        working_directory: Optional[PathLike] = None,
+    ):
+        super().__init__(name, restore, working_directory=working_directory)
+
+        # Git ignores "--filter" for clones from plain local paths, so we convert
+        # these to file URLs to get a real partial clone
+        if "://" not in url and Path(url).exists():
+            url = Path(url).resolve().as_uri()
+        self.url = url
+        self.branch = branch
+        self.prefix = name if prefix is None else prefix
+
+    @property
+    def checkout(self) -> Path:
+        return self.working_directory / f"{self.name}.git"
+
+    def repo_path(self, file: PathLike) -> str:
+        return f"{self.prefix}/{path_to_identifier(file)}"
+
+    def checkout_file(self, file: PathLike) -> Path:
+        return self.checkout / self.repo_path(file)
+
+    @property
+    def sizes_path(self) -> str:
+        # A small file in the snapshot recording the size of each staged path, so
+        # that restores can be planned without fetching any of the blobs
+        return f"{self.prefix}/.snakemake-staging-sizes.json"
+
+    def snakefile(self) -> Path:
+        return package_data("workflow", "rules", "git.smk")
+
+    def is_cached(self, file: PathLike) -> bool:
+        if self.restore:
+            return Path(file).exists()
+        return is_up_to_date(self.upload_flag_file, file)
+
+    def transfer_size(self, file: PathLike) -> Optional[int]:
+        if self.restore:
+            size = file_size(self.checkout_file(file))
+            if size is None:
+                size = self.remote_sizes.get(self.repo_path(file))
+            return size
+        return file_size(file)
+
+    @cached_property
+    def remote_sizes(self) -> Dict[str, int]:
+        try:
+            self.clone()
+        except RuntimeError:
+            return {}
+        ref = self.remote_ref
+        return {} if ref is None else self.read_sizes(ref)
+
+    def read_sizes(self, ref: str) -> Dict[str, int]:
+        result = self.git("show", f"{ref}:{self.sizes_path}", check=False)
+        if result.returncode:
+            return {}
+        return json.loads(result.stdout)
+
+    def git(
+        self,
+        *args: str,
+        check: bool = True,
+        env: Optional[Dict[str, str]] = None,
+        input_lines: Optional[List[str]] = None,
+    ) -> subprocess.CompletedProcess[str]:
+        stdin = None
+        if input_lines is not None:
+            stdin = "".join(f"{line}\n" for line in input_lines)
+        result = subprocess.run(
+            ["git", *args],
+            input=stdin,
+            check=False,
+            capture_output=True,
+            text=True,
+            cwd=self.checkout,
+            env=None if env is None else dict(os.environ, **env),
+        )
+        if check and result.returncode:
+            raise RuntimeError(
+                f"Git command 'git {' '.join(args)}' failed for stage "
+                f"{self.name}:\n{result.stderr}"
+            )
+        return result
+
+    def clone(self) -> None:
+        # Make a blobless partial clone of the remote, without checking anything
+        # out. Blobs are only fetched on demand for the paths that we check out.
+        if (self.checkout / ".git").is_dir():
+            self.git("fetch", "--quiet", "origin")
+            return
+        if self.checkout.exists():
+            shutil.rmtree(self.checkout)
+        self.checkout.parent.mkdir(parents=True, exist_ok=True)
+        result = subprocess.run(
+            [
+                "git",
+                "clone",
+                "--quiet",
+                "--filter=blob:none",
+                "--no-checkout",
+                self.url,
+                str(self.checkout),
+            ],
+            check=False,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode:
+            raise RuntimeError(
+                f"Failed to clone {self.url} for stage {self.name}:\n{result.stderr}"
+            )
+
+        # Commits are only ever made in this private clone, so we provide a
+        # fallback identity if the user hasn't configured one
+        if self.git("config", "user.email", check=False).returncode:
+            self.git("config", "user.email", "snakemake-staging@localhost")
+        if self.git("config", "user.name", check=False).returncode:
+            self.git("config", "user.name", f"snakemake-staging/v{__version__}")
+
+    @property
+    def remote_ref(self) -> Optional[str]:
+        ref = f"refs/remotes/origin/{self.branch}"
+        if self.git("rev-parse", "--verify", "--quiet", ref, check=False).returncode:
+            return None
+        return ref
+
+    def prepare_restore(self) -> None:
+        self.clone()
+        ref = self.remote_ref
+        if ref is None:
+            raise RuntimeError(
+                f"Branch {self.branch} does not exist in {self.url} for stage "
+                f"{self.name}"
+            )
+
+        # Only the staged paths are checked out, so only their blobs are fetched
+        paths = sorted(f"/{self.repo_path(file)}" for file in self.files.values())
+        self.git("sparse-checkout", "set", "--no-cone", "--stdin", input_lines=paths)
+        start = time.monotonic()
+        self.git("checkout", "--quiet", "--force", "-B", self.branch, ref)
+        seconds = time.monotonic() - start
+
+        total = 0
+        for file in self.files.values():
+            size = file_size(self.checkout_file(file))
+            if size is None:
+                raise RuntimeError(
+                    f"File {file} not found in branch {self.branch} of {self.url} "
+                    f"for stage {self.name}"
+                )
+            total += size
+        self.record_transfer("download", total, seconds)
+
+    def restore_file(self, file: PathLike) -> None:
+        target = Path(file)
+        if target.is_dir():
+            shutil.rmtree(target)
+        copy_file_or_directory(self.checkout_file(file), target)
+
+    def snapshot(
+        self,
+        message: Optional[str] = None,
+        files: Optional[Iterable[PathLike]] = None,
+    ) -> bool:
+        # Snapshot all the files in the stage, replacing the previous snapshot, or
+        # just update the given files if provided
+        self.clone()
+        ref = self.remote_ref
+
+        # We build the new commit in a temporary index starting from the current
+        # remote tree so that nothing needs to be checked out. Unchanged files
+        # hash to blobs that already exist on the remote, so only changed blobs
+        # are included in the push.
+        index_file = self.checkout / ".git" / f"staging-{self.name}.index"
+        if index_file.exists():
+            index_file.unlink()
+        env = {"GIT_INDEX_FILE": str(index_file.resolve())}
+        try:
+            sizes: Dict[str, int] = {}
+            if ref is None:
+                self.git("read-tree", "--empty", env=env)
+            else:
+                self.git("read-tree", ref, env=env)
+                if files is not None:
+                    sizes = self.read_sizes(ref)
+            if files is None:
+                files = self.files.values()
+                self.git(
+                    "rm",
+                    "-r",
+                    "--cached",
+                    "--quiet",
+                    "--ignore-unmatch",
+                    "--",
+                    self.prefix,
+                    env=env,
+                )
+
+            cacheinfo = []
+            source_sizes: Dict[str, int] = {}
+            for file in files:
+                sizes[self.repo_path(file)] = 0
+                for source, path in _walk(Path(file), self.repo_path(file)):
+                    blob = self.git(
+                        "hash-object", "-w", "--", str(Path(source).resolve())
+                    ).stdout.strip()
+                    mode = "100755" if os.access(source, os.X_OK) else "100644"
+                    cacheinfo.append(f"{mode} {blob}\t{path}")
+                    source_sizes[path] = source.stat().st_size
+                    sizes[self.repo_path(file)] += source_sizes[path]
+            blob = self.git(
+                "hash-object",
+                "-w",
+                "--stdin",
+                input_lines=[json.dumps(sizes, indent=2, sort_keys=True)],
+            ).stdout.strip()
+            cacheinfo.append(f"100644 {blob}\t{self.sizes_path}")
+            self.git("update-index", "--index-info", env=env, input_lines=cacheinfo)
+            # Without "--missing-ok", write-tree would fetch every blob in the
+            # index to check that it exists, including those for other stages
+            tree = self.git("write-tree", "--missing-ok", env=env).stdout.strip()
+        finally:
+            if index_file.exists():
+                index_file.unlink()
+
+        if ref is None:
+            changed = list(source_sizes)
+        else:
+            parent_tree = self.git("rev-parse", f"{ref}^{{tree}}").stdout.strip()
+            if tree == parent_tree:
+                return False
+            changed = self.git(
+                "diff-tree", "-r", "-z", "--name-only", parent_tree, tree
+            ).stdout.split("\0")
+
+        if message is None:
+            message = f"Snapshot of stage {self.name}"
+        args = ["commit-tree", tree, "-m", message]
+        if ref is not None:
+            args += ["-p", ref]
+        commit = self.git(*args).stdout.strip()
+        start = time.monotonic()
+        self.git("push", "--quiet", "origin", f"{commit}:refs/heads/{self.branch}")
+        self.record_transfer(
+            "upload",
+            sum(source_sizes.get(path, 0) for path in changed),
+            time.monotonic() - start,
+        )
+        self.git("update-ref", f"refs/remotes/origin/{self.branch}", commit)
+        return True
+
+    def snapshot_file(self, file: PathLike) -> None:
+        self.snapshot(files=[file])
+
+    def upload_many(
+        self, files: Iterable[PathLike], jobs: int = 1
+    ) -> Iterator[TransferResult]:
+        # All the files are pushed in a single commit, so they all succeed or fail
+        # together
+        files = list(files)
+        try:
+            self.snapshot(files=files)
+        except Exception as e:
+            for file in files:
+                yield TransferResult(file, e)
+        else:
+            for file in files:
+                yield TransferResult(file)
+
+    def verify_file(self, file: PathLike) -> bool:
+        (result,) = self.verify_many([file])
+        return result.ok
+
+    def verify_many(
+        self, files: Iterable[PathLike], jobs: int = 1
+    ) -> Iterator[TransferResult]:
+        # Compare the hashes of the local files to the blobs in the remote tree.
+        # This fetches once and lists the tree for the whole prefix, without
+        # fetching any blobs, and then hashes all the local files in one batch.
+        files = list(files)
+        self.clone()
+        ref = self.remote_ref
+        remote: Dict[str, str] = {}
+        if ref is not None:
+            listing = self.git("ls-tree", "-r", "-z", ref, "--", self.prefix).stdout
+            for entry in filter(None, listing.split("\0")):
+                info, path = entry.split("\t", 1)
+                remote[path] = info.split()[2]
+
+        sources = {
+            file: _walk(Path(file), self.repo_path(file))
+            for file in files
+            if Path(file).exists()
+        }
+        paths = sorted(
+            {
+                str(source.resolve())
+                for entries in sources.values()
+                for source, _ in entries
+            }
+        )
+        blobs: Dict[str, str] = {}
+        if paths:
+            output = self.git("hash-object", "--stdin-paths", input_lines=paths).stdout
+            blobs = dict(zip(paths, output.split()))
+        for file in files:
+            if file not in sources:
+                yield TransferResult(file, FileNotFoundError(f"File {file} not found"))
+                continue
+            matches = [
+                remote.get(path) == blobs[str(source.resolve())]
+                for source, path in sources[file]
+            ]
+            if all(matches):
+                yield TransferResult(file)
+            else:
+                yield TransferResult(
+                    file,
+                    RuntimeError(
+                        f"File {file} does not match the archived copy in stage "
+                        f"{self.name}"
+                    ),
+                )
+
+
+def _walk(source: Path, path: str) -> List[Tuple[Path, str]]:
+    if source.is_dir():
+        return [
+            (f, f"{path}/{f.relative_to(source).as_posix()}")
+            for f in sorted(source.glob("**/*"))
+            if f.is_file()
+        ]
+    return [(source, path)]
@@ -0,0 +1,114 @@
+import os
+import socket
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Optional
+
+from snakemake_staging.utils import PathLike
+
+
+class LeaseLock:
+    """A lock file that can be shared between processes and nodes
+
+    The lock is held by creating the lock file exclusively, and the holder must
+    call ``refresh`` at least once per ``lease`` seconds to keep it. A lock that
+    hasn't been refreshed within its lease is assumed to belong to a dead process
+    and is taken over.
+    """
+
+    def __init__(self, path: PathLike, lease: float = 120.0, poll: float = 0.5):
+        self.path = Path(path)
+        self.lease = lease
+        self.poll = poll
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self._last_refresh = 0.0
+
+    def acquire(self, timeout: Optional[float] = None) -> None:
+        start = time.monotonic()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, "w") as f:
+                    f.write(self.token)
+                self._last_refresh = time.monotonic()
+                return
+
+            self._break_if_stale()
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"Timed out waiting for lock {self.path}")
+            time.sleep(self.poll)
+
+    def refresh(self, force: bool = False) -> None:
+        # Throttled so that this can be called cheaply from inside transfer loops
+        now = time.monotonic()
+        if force or now - self._last_refresh > self.lease / 4:
+            self._last_refresh = now
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                pass
+
+    def release(self) -> None:
+        # Only remove the lock file if we still own it; it might have been taken
+        # over if we failed to refresh it in time
+        if _read(self.path) == self.token:
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self) -> "LeaseLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.release()
+
+    def _break_if_stale(self) -> None:
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return
+        if time.time() - mtime <= self.lease:
+            return
+        token = _read(self.path)
+
+        # Move the stale lock out of the way atomically so that only one waiter
+        # can take it over. If it changed between reading and moving it, another
+        # process got there first and we put its lock back.
+        stale = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return
+        if _read(stale) != token:
+            try:
+                os.link(stale, self.path)
+            except FileExistsError:
+                pass
+        stale.unlink()
+
+
+def _read(path: Path) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def lock_file_for(path: PathLike) -> Path:
+    path = Path(path)
+    return path.with_name(f".{path.name}.lock")
+
+
+def temp_file_for(path: PathLike) -> Path:
+    # A unique temporary file in the same directory as the target, so that it can
+    # be atomically renamed into place
+    path = Path(path)
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
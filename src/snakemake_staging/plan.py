@@ -0,0 +1,119 @@
+import json
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+from snakemake_staging.stages import STAGES, Stage
+from snakemake_staging.utils import PathLike, format_bytes, format_duration
+
+
+class FilePlan(NamedTuple):
+    file: PathLike
+    size: Optional[int]
+    cached: bool
+
+
+class StagePlan(NamedTuple):
+    name: str
+    direction: str
+    files: List[FilePlan]
+    throughput: Optional[float]
+
+    @property
+    def transfer_files(self) -> List[FilePlan]:
+        return [f for f in self.files if not f.cached]
+
+    @property
+    def transfer_bytes(self) -> int:
+        return sum(f.size or 0 for f in self.transfer_files)
+
+    @property
+    def cached_bytes(self) -> int:
+        return sum(f.size or 0 for f in self.files if f.cached)
+
+    @property
+    def unknown_files(self) -> int:
+        # The number of files that will be transferred, but whose size we don't know
+        return sum(f.size is None for f in self.transfer_files)
+
+    @property
+    def duration(self) -> Optional[float]:
+        if not self.transfer_files:
+            return 0.0
+        if self.throughput is None or self.unknown_files == len(self.transfer_files):
+            return None
+        return self.transfer_bytes / self.throughput
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "direction": self.direction,
+            "files": len(self.files),
+            "transfer_files": len(self.transfer_files),
+            "transfer_bytes": self.transfer_bytes,
+            "cached_files": len(self.files) - len(self.transfer_files),
+            "cached_bytes": self.cached_bytes,
+            "unknown_files": self.unknown_files,
+            "throughput": self.throughput,
+            "duration": self.duration,
+        }
+
+
+def plan_stage(stage: Stage, throughput: Optional[float] = None) -> StagePlan:
+    files = [
+        FilePlan(file, stage.transfer_size(file), stage.is_cached(file))
+        for file in stage.files.values()
+    ]
+    if throughput is None:
+        throughput = stage.throughput(stage.direction)
+    return StagePlan(stage.name, stage.direction, files, throughput)
+
+
+def plan(
+    stages: Optional[Iterable[Stage]] = None, throughput: Optional[float] = None
+) -> List[StagePlan]:
+    if stages is None:
+        stages = STAGES.values()
+    return [plan_stage(stage, throughput=throughput) for stage in stages]
+
+
+def format_plan(plans: Iterable[StagePlan], as_json: bool = False) -> str:
+    plans = list(plans)
+    if as_json:
+        return json.dumps([p.to_dict() for p in plans], indent=2)
+
+    lines = []
+    total_bytes = 0
+    total_duration: Optional[float] = 0.0
+    for p in plans:
+        lines.append(f"{p.name} ({p.direction}):")
+        lines.append(
+            f"  {len(p.transfer_files)} of {len(p.files)} files to {p.direction}, "
+            f"{format_bytes(p.transfer_bytes)}"
+        )
+        if p.unknown_files:
+            lines.append(f"  {p.unknown_files} files with unknown size")
+        lines.append(
+            f"  {len(p.files) - len(p.transfer_files)} files up to date, "
+            f"{format_bytes(p.cached_bytes)}"
+        )
+        if p.duration is None:
+            lines.append("  estimated time: unknown (no recorded transfers)")
+        elif p.throughput is None:
+            lines.append(f"  estimated time: {format_duration(p.duration)}")
+        else:
+            lines.append(
+                f"  estimated time: {format_duration(p.duration)} "
+                f"at {format_bytes(p.throughput)}/s"
+            )
+
+        total_bytes += p.transfer_bytes
+        if total_duration is not None and p.duration is not None:
+            total_duration += p.duration
+        else:
+            total_duration = None
+
+    lines.append(f"total: {format_bytes(total_bytes)}")
+    if total_duration is None:
+        lines.append("  estimated time: unknown")
+    else:
+        lines.append(f"  estimated time: {format_duration(total_duration)}")
+    return "\n".join(lines)
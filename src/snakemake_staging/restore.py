@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from snakemake_staging.stages import STAGES, Stage, TransferResult
+from snakemake_staging.utils import PathLike
+
+
+def restore(
+    stages: Optional[Iterable[Stage]] = None,
+    jobs: int = 8,
+    force: bool = False,
+    progress: bool = True,
+) -> List[PathLike]:
+    # Restore all the files for the given stages outside of Snakemake, using each
+    # stage's bulk download method with up to "jobs" concurrent transfers. Only
+    # stages configured to restore are included, and files that already exist
+    # are skipped unless "force" is set.
+    if stages is None:
+        stages = STAGES.values()
+    stages = [stage for stage in stages if stage.restore]
+
+    tasks: List[Tuple[Stage, List[PathLike]]] = []
+    for stage in stages:
+        files = [
+            file for file in stage.files.values() if force or not Path(file).exists()
+        ]
+        if files:
+            tasks.append((stage, files))
+
+    restored: List[PathLike] = []
+    failed: List[TransferResult] = []
+    total = sum(len(files) for _, files in tasks)
+    with _progress(total, enabled=progress) as advance:
+        for stage, files in tasks:
+            stage.prepare_restore()
+            for file in files:
+                Path(file).parent.mkdir(parents=True, exist_ok=True)
+            for result in stage.download_many(files, jobs=jobs):
+                if result.ok:
+                    restored.append(result.file)
+                else:
+                    failed.append(result)
+                advance(f"{stage.name}: {result.file}")
+
+    if failed:
+        raise RuntimeError(
+            "Failed to restore the following files:\n"
+            + "\n".join(f"- {r.file}: {r.error}" for r in failed)
+        ) from failed[0].error
+
+    # Snakemake reruns a rule if any input is newer than its outputs, so we bump
+    # the restored files past everything that the restore rules depend on (e.g.
+    # stage info files) that was modified while restoring
+    now = time.time()
+    for file in restored:
+        os.utime(file, (now, now))
+
+    return restored
+
+
+class _progress:
+    def __init__(self, total: int, enabled: bool = True):
+        self.total = total
+        self.enabled = enabled
+        self.count = 0
+        self._rich: Any = None
+        self._task: Any = None
+
+    def __enter__(self) -> Callable[[str], None]:
+        if self.enabled:
+            try:
+                from rich.progress import Progress
+            except ImportError:
+                pass
+            else:
+                self._rich = Progress()
+                self._rich.start()
+                self._task = self._rich.add_task("Restoring", total=self.total)
+        return self.advance
+
+    def advance(self, description: str) -> None:
+        self.count += 1
+        if not self.enabled:
+            return
+        if self._rich is not None:
+            self._rich.update(self._task, advance=1, description=description)
+        else:
+            print(f"[{self.count}/{self.total}] {description}", file=sys.stderr)
+
+    def __exit__(self, *_: Any) -> None:
+        if self._rich is not None:
+            self._rich.stop()
@@ -1,14 +1,66 @@
+import filecmp
+import json
 from abc import ABC, abstractmethod
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Optional
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+)
 
 from snakemake_staging.config import _CONFIG
-from snakemake_staging.utils import PathLike, package_data, path_to_identifier
+from snakemake_staging.utils import (
+    PathLike,
+    copy_file_or_directory,
+    file_size,
+    is_up_to_date,
+    package_data,
+    path_to_identifier,
+)
 
 STAGES: OrderedDict[str, "Stage"] = OrderedDict()
 
 
+class TransferResult(NamedTuple):
+    file: PathLike
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _transfer(func: Callable[[PathLike], Any], file: PathLike) -> TransferResult:
+    try:
+        func(file)
+    except Exception as e:
+        return TransferResult(file, e)
+    return TransferResult(file)
+
+
+def map_files(
+    func: Callable[[PathLike], Any], files: Iterable[PathLike], jobs: int = 1
+) -> Iterator[TransferResult]:
+    # Apply a per-file operation to each file, yielding the results in the order
+    # that they finish. Errors are captured in the results rather than raised so
+    # that one failure doesn't abandon the other transfers.
+    if jobs <= 1:
+        for file in files:
+            yield _transfer(func, file)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_transfer, func, file) for file in files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
 class Stage(ABC):
     def __init__(
         self, name: str, restore: bool, working_directory: Optional[PathLike] = None
@@ -31,6 +83,14 @@ class Stage(ABC):
     def upload_flag_file(self) -> Path:
         return self.working_directory / f"{self.name}.upload"
 
+    @property
+    def transfer_log_file(self) -> Path:
+        return self.working_directory / f"{self.name}.transfers.jsonl"
+
+    @property
+    def direction(self) -> str:
+        return "download" if self.restore else "upload"
+
     def __call__(self, *files: PathLike) -> List[PathLike]:
         return self.staged(*files)
 
@@ -55,6 +115,101 @@ class Stage(ABC):
     def snakefile(self) -> Path:
         ...
 
+    def prepare_restore(self) -> None:
+        # Called once before any files are restored outside of Snakemake, for
+        # backends that need to do some setup before restoring individual files
+        return None
+
+    # The per-file methods below are optional capabilities that are used to
+    # transfer files outside of Snakemake (e.g. by the restore command and the
+    # bulk transfer methods). All the stages in this package implement them, and
+    # stages that don't raise NotImplementedError when they are used.
+
+    def restore_file(self, file: PathLike) -> None:
+        raise NotImplementedError(
+            f"Stage {self.name} does not support restoring files outside of Snakemake"
+        )
+
+    def snapshot_file(self, file: PathLike) -> None:
+        raise NotImplementedError(
+            f"Stage {self.name} does not support snapshotting files outside of "
+            "Snakemake"
+        )
+
+    def verify_file(self, file: PathLike) -> bool:
+        raise NotImplementedError(f"Stage {self.name} does not support verification")
+
+    # The bulk transfer methods below yield a TransferResult for each file as it
+    # finishes. By default, these just loop over the per-file methods, but
+    # backends can override them to batch or overlap transfers. Up to "jobs"
+    # files are transferred concurrently.
+
+    def upload_many(
+        self, files: Iterable[PathLike], jobs: int = 1
+    ) -> Iterator[TransferResult]:
+        return map_files(self.snapshot_file, files, jobs=jobs)
+
+    def download_many(
+        self, files: Iterable[PathLike], jobs: int = 1
+    ) -> Iterator[TransferResult]:
+        return map_files(self.restore_file, files, jobs=jobs)
+
+    def verify_many(
+        self, files: Iterable[PathLike], jobs: int = 1
+    ) -> Iterator[TransferResult]:
+        def verify(file: PathLike) -> None:
+            if not self.verify_file(file):
+                raise RuntimeError(
+                    f"File {file} does not match the archived copy in stage "
+                    f"{self.name}"
+                )
+
+        return map_files(verify, files, jobs=jobs)
+
+    def transfer_size(self, file: PathLike) -> Optional[int]:
+        # The number of bytes that would be transferred to snapshot or restore
+        # this file, or None if this can't be determined ahead of time. By
+        # default, we only know the size of local files that will be snapshotted.
+        if self.restore:
+            return None
+        return file_size(file)
+
+    def is_cached(self, file: PathLike) -> bool:
+        # Whether the transfer for this file would be skipped by Snakemake
+        # because its outputs are already up to date
+        if self.restore:
+            return Path(file).exists()
+        return False
+
+    def record_transfer(self, direction: str, size: int, seconds: float) -> None:
+        # Append a measurement to the transfer log for this stage; these are
+        # used to estimate the duration of future transfers
+        self.transfer_log_file.parent.mkdir(parents=True, exist_ok=True)
+        line = json.dumps({"direction": direction, "bytes": size, "seconds": seconds})
+        with open(self.transfer_log_file, "a") as f:
+            f.write(line + "\n")
+
+    def throughput(self, direction: str, window: int = 50) -> Optional[float]:
+        # The mean throughput in bytes per second over the most recent transfers
+        # in the given direction, or None if no transfers have been recorded
+        if not self.transfer_log_file.exists():
+            return None
+        records: List[Dict[str, Any]] = []
+        with open(self.transfer_log_file, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("direction") == direction:
+                    records.append(record)
+        records = records[-window:]
+        total_bytes = sum(r["bytes"] for r in records)
+        total_seconds = sum(r["seconds"] for r in records)
+        if total_bytes <= 0 or total_seconds <= 0:
+            return None
+        return total_bytes / total_seconds
+
 
 class NoOpStage(Stage):
     @property
@@ -63,3 +218,53 @@ class NoOpStage(Stage):
 
     def snakefile(self) -> Path:
         return package_data("workflow", "rules", "noop.smk")
+
+    def restore_file(self, file: PathLike) -> None:
+        copy_file_or_directory(self.directory / path_to_identifier(file), file)
+
+    def snapshot_file(self, file: PathLike) -> None:
+        copy_file_or_directory(file, self.directory / path_to_identifier(file))
+
+    def verify_file(self, file: PathLike) -> bool:
+        staged = self.directory / path_to_identifier(file)
+        if not Path(file).is_file() or not staged.is_file():
+            return False
+        return filecmp.cmp(file, staged, shallow=False)
+
+    def transfer_size(self, file: PathLike) -> Optional[int]:
+        if self.restore:
+            return file_size(self.directory / path_to_identifier(file))
+        return file_size(file)
+
+    def is_cached(self, file: PathLike) -> bool:
+        if self.restore:
+            return Path(file).exists()
+        return is_up_to_date(self.directory / path_to_identifier(file), file)
+
+
+def load_stages(
+    snakefile: PathLike = "Snakefile", config: Optional[Dict[str, Any]] = None
+) -> "OrderedDict[str, Stage]":
+    # Parse the Snakefile (without building or executing the DAG) to populate
+    # the global stage registry. This needs to be run from the workflow's
+    # working directory since stage paths are relative.
+    from snakemake.api import SnakemakeApi
+    from snakemake.settings.enums import Quietness
+    from snakemake.settings.types import (
+        ConfigSettings,
+        OutputSettings,
+        ResourceSettings,
+    )
+
+    STAGES.clear()
+    _CONFIG.clear()
+    output_settings = OutputSettings(quiet={Quietness.ALL})
+    with SnakemakeApi(output_settings) as api:
+        workflow = api.workflow(
+            resource_settings=ResourceSettings(),
+            config_settings=ConfigSettings(config=dict(config or {})),
+            snakefile=Path(snakefile),
+        )
+        # Constructing the DAG API is what triggers the Snakefile to be parsed
+        workflow.dag()
+    return STAGES
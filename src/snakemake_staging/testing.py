@@ -1,15 +1,15 @@
 import filecmp
 import hashlib
-import os
 import platform
 import shutil
 import subprocess
 import sys
 import weakref
-from contextlib import contextmanager
 from pathlib import Path
 from tempfile import TemporaryDirectory as _TemporaryDirectory
-from typing import Any, Generator, Iterable, List, Optional, Union
+from typing import Any, Iterable, List, Optional, Union
+
+from snakemake_staging.utils import cwd
 
 PathLike = Union[str, Path]
 
@@ -18,16 +18,6 @@ PathLike = Union[str, Path]
 conda_prefix = str(Path().resolve() / ".test" / "conda")
 
 
-@contextmanager
-def cwd(path: PathLike) -> Generator[None, None, None]:
-    old_dir = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(old_dir)
-
-
 class TemporaryDirectory:
     def __init__(
         self, path: PathLike, args: Iterable[str] = (), force_explicit: bool = False
@@ -1,8 +1,10 @@
 import hashlib
+import os
 import shutil
+from contextlib import contextmanager
 from importlib.resources import as_file, files
 from pathlib import Path
-from typing import Optional, Union
+from typing import Any, Callable, Generator, Optional, Union
 
 PathLike = Union[str, Path]
 
@@ -40,3 +42,71 @@ def copy_file_or_directory(src: PathLike, dst: PathLike) -> None:
         shutil.copytree(src, dst)
     else:
         shutil.copyfile(src, dst)
+
+
+def file_size(path: PathLike) -> Optional[int]:
+    path = Path(path)
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.glob("**/*") if f.is_file())
+    if path.is_file():
+        return path.stat().st_size
+    return None
+
+
+def is_up_to_date(target: PathLike, source: PathLike) -> bool:
+    # This mirrors Snakemake's logic for deciding if an output needs to be
+    # regenerated: the target must exist and be newer than its source
+    target = Path(target)
+    source = Path(source)
+    if not target.exists():
+        return False
+    if not source.exists():
+        return True
+    return target.stat().st_mtime >= source.stat().st_mtime
+
+
+def format_bytes(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(size) < 1000 or unit == "TB":
+            break
+        size /= 1000
+    if unit == "B":
+        return f"{int(size)} {unit}"
+    return f"{size:.1f} {unit}"
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
+
+
+def file_md5(
+    path: PathLike,
+    chunk_size: int = 1 << 20,
+    callback: Optional[Callable[[], Any]] = None,
+) -> str:
+    # The callback is called after each chunk, e.g. to keep a lock alive while
+    # hashing a large file
+    checksum = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+            if callback is not None:
+                callback()
+    return checksum.hexdigest()
+
+
+@contextmanager
+def cwd(path: PathLike) -> Generator[None, None, None]:
+    old_dir = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old_dir)
@@ -1,16 +1,44 @@
-from snakemake_staging.utils import package_data, working_directory
+from snakemake_staging import git, stages, utils
 
-checkout = working_directory("staging", "git", "checkout", "{repo}", config=config)
+for name, stage in stages.STAGES.items():
+    if not isinstance(stage, git.GitStage):
+        continue
 
-rule staging__git__clone:
-    output:
-        directory(checkout)
-    conda:
-        package_data("workflow", "envs", "git.yml")
-    params:
-        url=lambda wildcards: get,
-        branch="master"
-    shell:
-        "git clone {params.url} {output}"
+    # Rules for restoring or snapshotting the staging checkout based on the
+    # restore configuration
+    if stage.restore:
+        rule:
+            name:
+                utils.rule_name("git", name, "checkout")
+            message:
+                f"Checking out staged files for stage '{name}'"
+            output:
+                [stage.checkout_file(file) for file in stage.files.values()]
+            run:
+                stage.prepare_restore()
 
+        for file in stage.files.values():
+            rule:
+                name:
+                    utils.rule_name("git", name, "restore", path=file)
+                message:
+                    f"Restoring file '{file}' for stage '{name}'"
+                input:
+                    stage.checkout_file(file)
+                output:
+                    file
+                run:
+                    stage.restore_file(output[0])
 
+    else:
+        rule:
+            name:
+                utils.rule_name("git", name, "snapshot")
+            message:
+                f"Snapshotting stage '{name}'"
+            input:
+                list(stage.files.values())
+            output:
+                touch(stage.upload_flag_file)
+            run:
+                stage.snapshot()
@@ -7,6 +7,22 @@ for name, stage in stages.STAGES.items():
     # Rules for restoring or snapshotting the staging directory based on the
     # restore configuration
     if stage.restore:
+        # If the stage is restored from a DOI, the record metadata is fetched by
+        # a rule, and any cached copy is revalidated before the download jobs use
+        # it
+        if stage.record_id is not None:
+            stage.refresh_info()
+
+            rule:
+                name:
+                    utils.rule_name("zenodo", name, "fetch")
+                message:
+                    f"Fetching record metadata for stage '{name}'"
+                output:
+                    stage.info_file
+                run:
+                    stage.fetch_info(force=True)
+
         for file in stage.files.values():
             rule:
                 name:
@@ -20,6 +36,22 @@ for name, stage in stages.STAGES.items():
                 run:
                     stage.download_file(input[0], file)
 
+    elif stage.is_sharded:
+        # Sharded stages are published by a single job, since the shards can
+        # only be planned once the sizes of all the files are known
+        rule:
+            name:
+                utils.rule_name("zenodo", name, "publish")
+            message:
+                f"Publishing sharded stage '{name}'"
+            input:
+                list(stage.files.values())
+            output:
+                stage.info_file,
+                touch(stage.upload_flag_file)
+            run:
+                stage.publish_shards(output[0])
+
     else:
         rule:
             name:
@@ -57,4 +89,4 @@ for name, stage in stages.STAGES.items():
                 stage.info_file,
                 touch(stage.upload_flag_file)
             run:
-                stage.publish_draft(input[0], output[0])
+                stage.publish_draft(input[0], output[0], *input[1:])
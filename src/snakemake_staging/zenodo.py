@@ -1,18 +1,56 @@
 import hashlib
 import json
 import os
+import re
+import time
+import warnings
 from functools import cached_property
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-from snakemake_staging.stages import Stage
-from snakemake_staging.utils import PathLike, package_data, path_to_identifier
+from snakemake_staging.compression import (
+    CHUNK_SIZE,
+    CODECS,
+    Codec,
+    compress_file,
+    estimate_compressed_size,
+    get_codec,
+    is_compressible,
+)
+from snakemake_staging.locking import LeaseLock, lock_file_for, temp_file_for
+from snakemake_staging.stages import Stage, map_files
+from snakemake_staging.utils import (
+    PathLike,
+    file_md5,
+    file_size,
+    is_up_to_date,
+    package_data,
+    path_to_identifier,
+)
 from snakemake_staging.version import __version__
 
+# Zenodo's per-record limits on the number of files and their total size
+ZENODO_MAX_FILES = 100
+ZENODO_MAX_BYTES = 50 * 1000**3
+
+# The names of the files that are uploaded alongside the staged files, since the
+# records API doesn't return the metadata that we save locally when publishing:
+# the manifest of staged files, and the list of shards for an index record
+MANIFEST_FILENAME = "snakemake-staging-manifest.json"
+INDEX_FILENAME = "snakemake-staging-index.json"
+
 
 class ZenodoStage(Stage):
     def __init__(
@@ -24,10 +62,35 @@ class ZenodoStage(Stage):
         sandbox: bool = False,
         token: Optional[str] = None,
         working_directory: Optional[PathLike] = None,
+        compression: Optional[str] = None,
+        lock_lease: float = 120.0,
+        doi: Optional[str] = None,
+        record_id: Optional[Union[str, int]] = None,
+        metadata_max_age: float = 300.0,
+        sharded: Optional[bool] = None,
+        max_shard_files: int = ZENODO_MAX_FILES,
+        max_shard_bytes: int = ZENODO_MAX_BYTES,
+        jobs: int = 4,
     ):
         super().__init__(name, restore, working_directory=working_directory)
         self._info_file = info_file
-        if self.info_file.exists():
+        self.compression = compression
+        self.lock_lease = lock_lease
+        self.metadata_max_age = metadata_max_age
+        self.sharded = sharded
+        self.max_shard_files = max_shard_files
+        self.max_shard_bytes = max_shard_bytes
+        self.jobs = jobs
+
+        # When a DOI or record ID is provided, the info file is a cache of the
+        # record metadata fetched from Zenodo
+        if doi is not None and record_id is None:
+            record_id = record_id_from_doi(doi)
+        self.record_id = None if record_id is None else str(record_id)
+
+        if doi is not None:
+            self.sandbox = doi.startswith("10.5072")
+        elif self.info_file.exists():
             with open(self.info_file, "r") as f:
                 info = json.load(f)
             self.sandbox = info.get("doi", "").startswith("10.5072")
@@ -35,23 +98,62 @@ class ZenodoStage(Stage):
             self.sandbox = sandbox
         self._token = token
         if url is None:
-            if sandbox:
+            if self.sandbox:
                 self.url = "https://sandbox.zenodo.org/api"
             else:
                 self.url = "https://zenodo.org/api"
         else:
             self.url = url
 
+    @classmethod
+    def from_info_file(
+        cls, info_file: PathLike, name: Optional[str] = None, **kwargs: Any
+    ) -> "ZenodoStage":
+        # Construct a stage for restoring a published record without a Snakefile,
+        # using the original paths saved in the record manifest
+        info_file = Path(info_file)
+        with open(info_file, "r") as f:
+            info = json.load(f)
+        manifest = info.get("snakemake_staging", {}).get("files", {})
+        paths = [entry["path"] for entry in manifest.values() if "path" in entry]
+        if not paths:
+            raise ValueError(
+                f"The record metadata file {info_file} doesn't list the paths of "
+                "the staged files; it must be restored using the Snakefile"
+            )
+        if name is None:
+            name = info_file.name.split(".")[0]
+        stage = cls(name, True, info_file=info_file, **kwargs)
+        stage.staged(*paths)
+        return stage
+
     @property
     def info_file(self) -> Path:
         if self._info_file is None:
             return self.working_directory / f"{self.name}.zenodo.json"
         return Path(self._info_file)
 
+    @property
+    def info_cache_file(self) -> Path:
+        return self.info_file.with_name(f"{self.info_file.name}.cache")
+
     @property
     def draft_info_file(self) -> Path:
         return self.working_directory / f"{self.name}.draft.zenodo.json"
 
+    @property
+    def is_sharded(self) -> bool:
+        # By default, stages are only sharded if they have too many files for a
+        # single record, since the file sizes aren't known when the workflow is
+        # parsed. Set "sharded" explicitly for stages with a few very large files.
+        if self.sharded is None:
+            return len(self.files) > self.max_shard_files
+        return self.sharded
+
+    @property
+    def shard_directory(self) -> Path:
+        return self.working_directory / f"{self.name}.zenodo"
+
     def upload_info_file(self, file: PathLike) -> Path:
         ident = path_to_identifier(file)
         return self.working_directory / f"{self.name}.zenodo" / f"{ident}.upload.json"
@@ -59,6 +161,33 @@ class ZenodoStage(Stage):
     def snakefile(self) -> PathLike:
         return package_data("workflow", "rules", "zenodo.smk")
 
+    @cached_property
+    def codec(self) -> Optional[Codec]:
+        if self.compression is None:
+            return None
+        return get_codec(self.compression)
+
+    def transfer_size(self, file: PathLike) -> Optional[int]:
+        if not self.restore:
+            # Compressed files are logged by their compressed size, so we estimate
+            # this here to be consistent with the measured throughput
+            if self.codec is not None and Path(file).is_file():
+                return estimate_compressed_size(file, self.codec)
+            return file_size(file)
+        if not self.info_file.exists():
+            return None
+        with open(self.info_file, "r") as f:
+            info = json.load(f)
+        file_info, _ = find_file(info, file)
+        if file_info is None:
+            return None
+        return file_info.get("filesize", None)
+
+    def is_cached(self, file: PathLike) -> bool:
+        if self.restore:
+            return Path(file).exists()
+        return is_up_to_date(self.upload_info_file(file), file)
+
     @cached_property
     def token(self) -> Optional[str]:
         if self._token is None:
@@ -116,6 +245,145 @@ class ZenodoStage(Stage):
                 raise
         return response
 
+    def fetch_info(self, force: bool = False) -> Path:
+        # Fetch the record metadata into the info file, revalidating any cached
+        # copy with a conditional request. Revalidation is skipped entirely if the
+        # cache was validated within the last "metadata_max_age" seconds, so
+        # that the many jobs in a single run share one request.
+        if self.record_id is None:
+            raise ValueError(
+                f"Stage {self.name} has no DOI or record ID to fetch metadata for"
+            )
+
+        with LeaseLock(lock_file_for(self.info_file), lease=self.lock_lease) as lock:
+            cache: Dict[str, Any] = {}
+            if self.info_file.exists() and self.info_cache_file.exists():
+                with open(self.info_cache_file, "r") as f:
+                    cache = json.load(f)
+                if cache.get("record_id") != self.record_id:
+                    cache = {}
+            if (
+                cache
+                and not force
+                and time.time() - cache.get("validated", 0) < self.metadata_max_age
+            ):
+                return self.info_file
+
+            headers = {}
+            if "etag" in cache:
+                headers["If-None-Match"] = cache["etag"]
+            if "last_modified" in cache:
+                headers["If-Modified-Since"] = cache["last_modified"]
+
+            try:
+                response = self.request(
+                    "GET",
+                    f"/records/{self.record_id}",
+                    require_token=False,
+                    check=False,
+                    headers=headers,
+                )
+                if response.status_code != 304:
+                    response.raise_for_status()
+            except requests.RequestException as e:
+                # Fall back to the cached metadata if we can't reach Zenodo
+                if not cache:
+                    raise
+                warnings.warn(
+                    f"Failed to revalidate metadata for record {self.record_id}; "
+                    f"using the cached copy in {self.info_file}: {e}",
+                    stacklevel=2,
+                )
+                return self.info_file
+
+            if response.status_code != 304:
+                # Only touch the info file if the metadata actually changed, since
+                # Snakemake will rerun the restore rules if it is updated
+                info = response.json()
+                previous = None
+                if self.info_file.exists():
+                    previous = _read_json(self.info_file)
+                    previous.pop("snakemake_staging", None)
+                if previous != info:
+                    info = self.resolve_record(info, refresh=lock.refresh)
+                    _write_json_atomic(self.info_file, info)
+                cache = {"record_id": self.record_id}
+                if "ETag" in response.headers:
+                    cache["etag"] = response.headers["ETag"]
+                if "Last-Modified" in response.headers:
+                    cache["last_modified"] = response.headers["Last-Modified"]
+            cache["validated"] = time.time()
+            _write_json_atomic(self.info_cache_file, cache)
+
+        return self.info_file
+
+    def refresh_info(self) -> None:
+        # Revalidate a previously fetched copy of the record metadata. This is
+        # called whenever the workflow is parsed (including for dry runs and on
+        # every cluster job), so it never fails; the metadata is first fetched by
+        # a rule instead.
+        if self.record_id is None or not self.info_file.exists():
+            return
+        try:
+            self.fetch_info()
+        except requests.RequestException as e:
+            warnings.warn(
+                f"Failed to revalidate metadata for record {self.record_id}: {e}",
+                stacklevel=2,
+            )
+
+    def resolve_record(
+        self,
+        info: Dict[str, Any],
+        refresh: Callable[[], Any] = lambda: None,
+    ) -> Dict[str, Any]:
+        # Load the manifest uploaded with a record fetched from the records API,
+        # and if this is the index record of a sharded stage, fetch each of the
+        # shards so that files can be located when restoring. This can take many
+        # requests, so "refresh" is called before each one to keep a lock alive.
+        filenames = {f["filename"] for f in file_entries(info)}
+        staging: Dict[str, Any] = {}
+        if MANIFEST_FILENAME in filenames:
+            refresh()
+            staging = self.download_json(info, MANIFEST_FILENAME)
+        if INDEX_FILENAME in filenames:
+            refresh()
+            index = self.download_json(info, INDEX_FILENAME)
+            shards = []
+            manifest: Dict[str, Any] = {}
+            for shard in index["shards"]:
+                refresh()
+                shard_info = self.resolve_record(
+                    self.request(
+                        "GET",
+                        f"/records/{shard['record_id']}",
+                        require_token=False,
+                        check=True,
+                    ).json(),
+                    refresh=refresh,
+                )
+                shards.append(shard_info)
+                manifest.update(
+                    shard_info.get("snakemake_staging", {}).get("files", {})
+                )
+            staging = {"files": manifest, "shards": shards}
+        if staging:
+            info = dict(info, snakemake_staging=staging)
+        return info
+
+    def download_json(self, info: Dict[str, Any], filename: str) -> Any:
+        return self.request(
+            "GET",
+            url=f"{record_html_url(info)}/files/{filename}",
+            require_token=False,
+            check=True,
+            params={"download": 1},
+        ).json()
+
+    def prepare_restore(self) -> None:
+        if self.record_id is not None:
+            self.fetch_info()
+
     def create_draft(self, info_file: PathLike, **metadata: Any) -> None:
         metadata_proc: Dict[str, Any] = {
             "title": f"Staged Snakemake Workflow: {self.name}",
@@ -147,33 +415,238 @@ This is a a snapshot of the outputs of a Snakemake workflow
 
         bucket_url = draft_info["links"]["bucket"]
         ident = path_to_identifier(file)
-        with open(file, "rb") as f:
-            response = self.request(
-                "PUT",
-                url=f"{bucket_url}/{ident}",
-                require_token=True,
-                check=True,
-                data=f,
+        manifest: Dict[str, Any] = {
+            "path": str(file),
+            "filename": ident,
+            "codec": None,
+            "size": Path(file).stat().st_size,
+        }
+
+        # Compress the file into the working directory before uploading, unless a
+        # sample shows that it is incompressible
+        codec = self.codec
+        upload_path = Path(file)
+        if codec is not None and is_compressible(file, codec):
+            upload_path = Path(upload_info_file).with_name(f"{ident}{codec.suffix}")
+            manifest["checksum"] = compress_file(file, upload_path, codec)
+            manifest["codec"] = codec.name
+            manifest["filename"] = f"{ident}{codec.suffix}"
+
+        start = time.monotonic()
+        try:
+            with open(upload_path, "rb") as f:
+                response = self.request(
+                    "PUT",
+                    url=f"{bucket_url}/{manifest['filename']}",
+                    require_token=True,
+                    check=True,
+                    data=f,
+                )
+            self.record_transfer(
+                "upload", upload_path.stat().st_size, time.monotonic() - start
             )
+        finally:
+            if upload_path != Path(file):
+                upload_path.unlink()
 
+        # The draft is recorded so that a retry can tell which files were
+        # already uploaded to it
+        upload_info = dict(
+            response.json(), draft_id=draft_info["id"], snakemake_staging=manifest
+        )
         with open(upload_info_file, "w") as f:
-            json.dump(response.json(), f, indent=2)
+            json.dump(upload_info, f, indent=2)
 
-    def publish_draft(self, draft_info_file: PathLike, info_file: PathLike) -> None:
+    def publish_draft(
+        self,
+        draft_info_file: PathLike,
+        info_file: PathLike,
+        *upload_info_files: PathLike,
+    ) -> None:
         with open(draft_info_file, "r") as f:
             draft_info = json.load(f)
         dep_id = draft_info["id"]
 
+        # Merge the manifest entries saved for each upload, since we need these to
+        # decompress the files on restore. These are uploaded with the record so
+        # that they are available when restoring from a DOI.
+        manifest: Dict[str, Any] = {}
+        for upload_info_file in upload_info_files:
+            with open(upload_info_file, "r") as f:
+                upload_info = json.load(f)
+            if "snakemake_staging" in upload_info:
+                entry = upload_info["snakemake_staging"]
+                manifest[entry["filename"]] = entry
+        if manifest:
+            self.request(
+                "PUT",
+                url=f"{draft_info['links']['bucket']}/{MANIFEST_FILENAME}",
+                require_token=True,
+                check=True,
+                data=json.dumps({"files": manifest}, indent=2),
+            )
+
         response = self.request(
             "POST",
             f"/deposit/depositions/{dep_id}/actions/publish",
             require_token=True,
             check=True,
         )
+        info = response.json()
+        if manifest:
+            info["snakemake_staging"] = {"files": manifest}
 
         # Save the draft data to the output file
         with open(info_file, "w") as f:
-            json.dump(response.json(), f, indent=2)
+            json.dump(info, f, indent=2)
+
+    def plan_shards(self) -> List[List[PathLike]]:
+        files = list(self.files.values())
+        sizes = [Path(file).stat().st_size for file in files]
+        return partition_files(
+            files, sizes, max_files=self.max_shard_files, max_bytes=self.max_shard_bytes
+        )
+
+    def publish_shards(self, info_file: PathLike, **metadata: Any) -> None:
+        # Split the files into shards that each fit within Zenodo's limits, and
+        # publish each shard as a record followed by an index record listing the
+        # shards. Published records can't be deleted, so all the files are
+        # uploaded before anything is published. The drafts are kept in the shard
+        # directory until everything is published so that a rerun after a failure
+        # reuses them rather than creating new depositions.
+        shards = self.plan_shards()
+        self.shard_directory.mkdir(parents=True, exist_ok=True)
+
+        # The plan records the size and modification time of each file, so that
+        # nothing from a previous attempt is reused if any of the files changed
+        plan = [
+            [
+                {
+                    "path": str(file),
+                    "size": Path(file).stat().st_size,
+                    "mtime_ns": Path(file).stat().st_mtime_ns,
+                }
+                for file in files
+            ]
+            for files in shards
+        ]
+        plan_file = self.shard_directory / "shards.json"
+        if plan_file.exists() and _read_json(plan_file) != plan:
+            self.discard_drafts()
+        _write_json_atomic(plan_file, plan)
+        title = f"Staged Snakemake Workflow: {self.name}"
+
+        # Create the drafts for any shards that haven't already been published,
+        # and upload their files using a single pool of "jobs" workers. Files that
+        # were already uploaded to the same draft by a previous attempt are
+        # skipped.
+        drafts: Dict[PathLike, Path] = {}
+        for n, files in enumerate(shards):
+            draft_info_file = self.shard_directory / f"shard-{n}.draft.json"
+            if (self.shard_directory / f"shard-{n}.json").exists():
+                continue
+            if not draft_info_file.exists():
+                self.create_draft(
+                    draft_info_file,
+                    **dict(metadata, title=f"{title} (shard {n + 1} of {len(shards)})"),
+                )
+            draft_id = _read_json(draft_info_file)["id"]
+            for file in files:
+                upload_info_file = self.upload_info_file(file)
+                if (
+                    is_up_to_date(upload_info_file, file)
+                    and _read_json(upload_info_file).get("draft_id") == draft_id
+                ):
+                    continue
+                drafts[file] = draft_info_file
+        results = map_files(
+            lambda file: self.upload_file(
+                drafts[file], file, self.upload_info_file(file)
+            ),
+            drafts,
+            jobs=self.jobs,
+        )
+        failed = [result for result in results if not result.ok]
+        if failed:
+            raise RuntimeError(
+                f"Failed to upload the following files for stage {self.name}; "
+                "nothing has been published:\n"
+                + "\n".join(f"- {r.file}: {r.error}" for r in failed)
+            ) from failed[0].error
+
+        # Publish the shards one at a time, saving each as it is published so
+        # that a rerun doesn't try to publish it again
+        shard_infos = []
+        for n, files in enumerate(shards):
+            shard_info_file = self.shard_directory / f"shard-{n}.json"
+            if not shard_info_file.exists():
+                self.publish_draft(
+                    self.shard_directory / f"shard-{n}.draft.json",
+                    shard_info_file,
+                    *[self.upload_info_file(file) for file in files],
+                )
+            shard_infos.append(_read_json(shard_info_file))
+
+        # Publish the index record, unless a previous attempt already did
+        index_draft_info_file = self.shard_directory / "index.draft.json"
+        index_info_file = self.shard_directory / "index.json"
+        if not index_info_file.exists():
+            index = {
+                "shards": [
+                    {
+                        "record_id": info.get("record_id", info.get("id")),
+                        "doi": info.get("doi"),
+                        "files": [f["filename"] for f in file_entries(info)],
+                    }
+                    for info in shard_infos
+                ]
+            }
+            if not index_draft_info_file.exists():
+                self.create_draft(index_draft_info_file, **dict(metadata, title=title))
+            draft_info = _read_json(index_draft_info_file)
+            self.request(
+                "PUT",
+                url=f"{draft_info['links']['bucket']}/{INDEX_FILENAME}",
+                require_token=True,
+                check=True,
+                data=json.dumps(index, indent=2),
+            )
+            self.publish_draft(index_draft_info_file, index_info_file)
+
+        # Save the shard metadata alongside the index record so that restores
+        # don't need to fetch it again
+        info = _read_json(index_info_file)
+        manifest: Dict[str, Any] = {}
+        for shard_info in shard_infos:
+            manifest.update(shard_info.get("snakemake_staging", {}).get("files", {}))
+        info["snakemake_staging"] = {"files": manifest, "shards": shard_infos}
+        _write_json_atomic(info_file, info)
+
+        # Everything is published, so the next snapshot starts from scratch
+        for path in [plan_file, index_draft_info_file, index_info_file]:
+            path.unlink()
+        for n in range(len(shards)):
+            (self.shard_directory / f"shard-{n}.draft.json").unlink(missing_ok=True)
+            (self.shard_directory / f"shard-{n}.json").unlink(missing_ok=True)
+
+    def discard_drafts(self) -> None:
+        # Delete the unpublished drafts left by a failed attempt to publish a
+        # sharded stage whose files have since changed. Any records that were
+        # already published can't be deleted, but they are no longer used.
+        for draft_info_file in self.shard_directory.glob("*.draft.json"):
+            published = draft_info_file.with_name(
+                draft_info_file.name.replace(".draft", "")
+            )
+            if not published.exists():
+                dep_id = _read_json(draft_info_file)["id"]
+                self.request(
+                    "DELETE",
+                    f"/deposit/depositions/{dep_id}",
+                    require_token=True,
+                    check=False,
+                )
+            draft_info_file.unlink()
+            published.unlink(missing_ok=True)
 
     def new_record(self, info_file: PathLike, *files: PathLike, **metadata: Any) -> str:
         # Set default metadata for required fields
@@ -230,41 +703,240 @@ This is a a snapshot of the outputs of a Snakemake workflow
 
             return dep_id
 
+    def restore_file(self, file: PathLike) -> None:
+        self.download_file(self.info_file, file)
+
+    def snapshot_file(self, file: PathLike) -> None:
+        # This requires that the draft has already been created
+        upload_info_file = self.upload_info_file(file)
+        upload_info_file.parent.mkdir(parents=True, exist_ok=True)
+        self.upload_file(self.draft_info_file, file, upload_info_file)
+
+    def verify_file(self, file: PathLike) -> bool:
+        if not Path(file).is_file():
+            return False
+        if self.restore:
+            file_info, manifest = find_file(_read_json(self.info_file), file)
+            if file_info is None:
+                return False
+            expected = restored_checksum(file_info, manifest)
+        else:
+            upload_info_file = self.upload_info_file(file)
+            if not upload_info_file.exists():
+                return False
+            upload_info = _read_json(upload_info_file)
+            manifest = upload_info.get("snakemake_staging", {})
+            if manifest.get("codec") is not None:
+                expected = manifest.get("checksum")
+            else:
+                # The bucket API reports checksums like "md5:<hex>"
+                expected = upload_info.get("checksum")
+                if expected is not None:
+                    expected = expected.split(":")[-1]
+        return expected is not None and file_md5(file) == expected
+
     def download_file(
         self, info_file: PathLike, file: PathLike, verify: bool = True
     ) -> None:
         with open(info_file, "r") as f:
             info = json.load(f)
 
-        # Search the info file for the file we want to download
-        ident = path_to_identifier(file)
-        download_url = f"{info['links']['record_html']}/files/{ident}"
-        file_info = list(
-            filter(lambda f: f["filename"] == ident, info.get("files", []))
-        )
-        if len(file_info) != 1:
+        # Search the info file (and its shards) for the file we want to download
+        record, file_info, manifest = locate_file(info, file)
+        if file_info is None:
             raise RuntimeError(
                 f"File {file} not found in record metadata file {info_file}"
             )
-        file_info = file_info[0]
+        filename = file_info["filename"]
+        download_url = f"{record_html_url(record)}/files/{filename}"
+        codec_name = manifest.get("codec", None)
+        decompressor = None
+        if codec_name is not None:
+            decompressor = get_codec(codec_name).decompressobj()
 
-        # Stream from the download URL directly into the target file
-        if verify:
-            checksum = hashlib.md5()
-        with self.request(
-            "GET",
-            url=download_url,
-            require_token=False,
-            check=True,
-            params={"download": 1},
-            stream=True,
-        ) as response:
-            with open(file, "wb") as f:
-                for chunk in response.iter_content(chunk_size=4096):
-                    if verify:
-                        checksum.update(chunk)
-                    f.write(chunk)
-
-        if verify:
-            if checksum.hexdigest() != file_info["checksum"]:
-                raise RuntimeError(f"Checksum mismatch for downloaded file {file}")
+        expected_checksum = restored_checksum(file_info, manifest)
+
+        # Several jobs or nodes may be restoring the same file into shared
+        # storage, so only one of them downloads it at a time. Once the lock is
+        # acquired, we first check whether a previous holder already restored
+        # the file, and reuse it if so.
+        with LeaseLock(lock_file_for(file), lease=self.lock_lease) as lock:
+            if (
+                expected_checksum is not None
+                and Path(file).is_file()
+                and file_md5(file, callback=lock.refresh) == expected_checksum
+            ):
+                return
+
+            # Stream from the download URL into a temporary file (decompressing
+            # on the fly if the archived file was compressed), and then move it
+            # into place atomically, so that a partial file is never visible
+            tmp = temp_file_for(file)
+            if verify:
+                checksum = hashlib.md5()
+                data_checksum = hashlib.md5()
+            size = 0
+            start = time.monotonic()
+            try:
+                with self.request(
+                    "GET",
+                    url=download_url,
+                    require_token=False,
+                    check=True,
+                    params={"download": 1},
+                    stream=True,
+                ) as response:
+                    with open(tmp, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            lock.refresh()
+                            if verify:
+                                checksum.update(chunk)
+                            size += len(chunk)
+                            data = chunk
+                            if decompressor is not None:
+                                data = decompressor.decompress(chunk)
+                            if verify:
+                                data_checksum.update(data)
+                            f.write(data)
+                        if decompressor is not None:
+                            data = decompressor.flush()
+                            if verify:
+                                data_checksum.update(data)
+                            f.write(data)
+                self.record_transfer("download", size, time.monotonic() - start)
+
+                if verify:
+                    expected = file_info["checksum"]
+                    if expected is not None and checksum.hexdigest() != expected:
+                        raise RuntimeError(
+                            f"Checksum mismatch for downloaded file {file}"
+                        )
+                    if "checksum" in manifest:
+                        if data_checksum.hexdigest() != manifest["checksum"]:
+                            raise RuntimeError(
+                                f"Checksum mismatch for decompressed file {file}"
+                            )
+
+                os.replace(tmp, file)
+            finally:
+                if tmp.exists():
+                    tmp.unlink()
+
+
+def record_id_from_doi(doi: str) -> str:
+    match = re.search(r"zenodo\.(\d+)$", doi.strip())
+    if match is None:
+        raise ValueError(f"'{doi}' is not a Zenodo DOI")
+    return match.group(1)
+
+
+def record_html_url(info: Dict[str, Any]) -> str:
+    # The deposition API calls this "record_html" while the records API calls it
+    # "self_html"
+    links = info["links"]
+    return links.get("record_html", links.get("self_html"))
+
+
+def file_entries(info: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Normalize the file listings from the deposition and records APIs, which use
+    # different keys and checksum formats
+    entries = []
+    for f in info.get("files", []):
+        entry = dict(f)
+        entry["filename"] = f.get("filename", f.get("key"))
+        entry["filesize"] = f.get("filesize", f.get("size"))
+        checksum = f.get("checksum")
+        if checksum is not None and ":" in checksum:
+            algorithm, checksum = checksum.split(":", 1)
+            if algorithm != "md5":
+                checksum = None
+        entry["checksum"] = checksum
+        entries.append(entry)
+    return entries
+
+
+def _read_json(path: PathLike) -> Any:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_json_atomic(path: PathLike, data: Any) -> None:
+    tmp = temp_file_for(path)
+    try:
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def restored_checksum(
+    file_info: Dict[str, Any], manifest: Dict[str, Any]
+) -> Optional[str]:
+    # The expected checksum of a restored (decompressed) file, if known
+    if manifest.get("codec", None) is None:
+        return file_info.get("checksum", None)
+    return manifest.get("checksum", None)
+
+
+def partition_files(
+    files: List[PathLike], sizes: List[int], max_files: int, max_bytes: int
+) -> List[List[PathLike]]:
+    # Pack the files into as few shards as possible using first-fit decreasing,
+    # keeping the original order of files within each shard
+    shards: List[List[int]] = []
+    totals: List[int] = []
+    for n in sorted(range(len(files)), key=lambda n: -sizes[n]):
+        if sizes[n] > max_bytes:
+            raise ValueError(
+                f"File {files[n]} is larger than the maximum shard size of "
+                f"{max_bytes} bytes"
+            )
+        for shard_n, shard in enumerate(shards):
+            if len(shard) < max_files and totals[shard_n] + sizes[n] <= max_bytes:
+                shard.append(n)
+                totals[shard_n] += sizes[n]
+                break
+        else:
+            shards.append([n])
+            totals.append(sizes[n])
+    return [[files[n] for n in sorted(shard)] for shard in shards]
+
+
+def locate_file(
+    info: Dict[str, Any], file: PathLike
+) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]], Dict[str, Any]]:
+    # Find the record containing a staged file, which is either the record itself
+    # or, for sharded stages, one of its shards
+    shards = info.get("snakemake_staging", {}).get("shards", None)
+    for record in shards or [info]:
+        file_info, manifest = _find_in_record(record, file)
+        if file_info is not None:
+            return record, file_info, manifest
+    return info, None, {}
+
+
+def find_file(
+    info: Dict[str, Any], file: PathLike
+) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    # Find the archived file for a staged file in the record metadata, along with
+    # its manifest entry
+    _, file_info, manifest = locate_file(info, file)
+    return file_info, manifest
+
+
+def _find_in_record(
+    info: Dict[str, Any], file: PathLike
+) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    # Compressed files are archived with a suffix, but we only trust this if the
+    # manifest says so, since staged files can have these suffixes themselves
+    ident = path_to_identifier(file)
+    files = {f["filename"]: f for f in file_entries(info)}
+    manifest = info.get("snakemake_staging", {}).get("files", {})
+    for filename in [ident] + [f"{ident}{c.suffix}" for c in CODECS.values()]:
+        if filename in files and filename in manifest:
+            return files[filename], manifest[filename]
+    if ident in files:
+        return files[ident], {}
+    return None, {}
@@ -0,0 +1,9 @@
+import pytest
+from snakemake_staging.stages import STAGES
+
+
+@pytest.fixture(autouse=True)
+def clear_stages():
+    STAGES.clear()
+    yield
+    STAGES.clear()
@@ -0,0 +1,160 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+from snakemake_staging.git import GitStage
+from snakemake_staging.testing import run_snakemake
+
+
+@pytest.fixture
+def remote(tmp_path: Path) -> str:
+    path = tmp_path / "remote.git"
+    subprocess.run(["git", "init", "--quiet", "--bare", str(path)], check=True)
+    subprocess.run(
+        ["git", "config", "uploadpack.allowFilter", "true"], cwd=path, check=True
+    )
+    return path.as_uri()
+
+
+def _git(path: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=path, check=True, capture_output=True, text=True
+    ).stdout
+
+
+def test_git_snapshot_restore(tmp_path: Path, remote: str):
+    a = tmp_path / "a.txt"
+    b = tmp_path / "b.txt"
+    a.write_text("a\n")
+    b.write_text("b\n")
+
+    stage = GitStage("snap", False, remote, working_directory=tmp_path / "snap")
+    stage(a, b)
+    assert stage.snapshot()
+
+    # Nothing has changed so there's nothing to push
+    assert not stage.snapshot()
+
+    # Only the changed file should be pushed in the next commit
+    b.write_text("changed\n")
+    assert stage.snapshot()
+    remote_path = tmp_path / "remote.git"
+    changed = _git(remote_path, "diff", "--name-only", "main~1", "main").split()
+    assert sorted(changed) == sorted([stage.repo_path(b), stage.sizes_path])
+
+    # Restore a single file with a partial clone and sparse checkout
+    c = tmp_path / "c.txt"
+    restore = GitStage(
+        "restore", True, remote, prefix="snap", working_directory=tmp_path / "restore"
+    )
+    restore(b)
+    restore.prepare_restore()
+    restore.restore_file(b)
+    assert b.read_text() == "changed\n"
+    assert not restore.checkout_file(a).exists()
+
+    # The blob for the file that wasn't restored should never have been fetched
+    objects = _git(restore.checkout, "rev-list", "--objects", "--missing=print", "main")
+    assert any(line.startswith("?") for line in objects.splitlines())
+
+    # Missing files are reported
+    restore = GitStage(
+        "missing", True, remote, prefix="snap", working_directory=tmp_path / "missing"
+    )
+    restore(c)
+    with pytest.raises(RuntimeError):
+        restore.prepare_restore()
+
+
+def test_git_project(tmp_path: Path, remote: str):
+    run_snakemake(
+        "tests/projects/git-snapshot",
+        "staging__upload",
+        "--config",
+        f"git_url={remote}",
+    )
+    run_snakemake(
+        "tests/projects/git-restore",
+        "output/a.txt",
+        "--config",
+        "restore=True",
+        f"git_url={remote}",
+    )
+
+
+def test_git_bulk_transfers(
+    tmp_path: Path, remote: str, monkeypatch: pytest.MonkeyPatch
+):
+    files = [tmp_path / f"{n}.txt" for n in range(3)]
+    for n, file in enumerate(files):
+        file.write_text(f"{n}\n")
+
+    stage = GitStage("bulk", False, remote, working_directory=tmp_path / "bulk")
+    stage(*files)
+    assert all(r.ok for r in stage.upload_many(files[:2]))
+    results = {r.file: r.ok for r in stage.verify_many(files)}
+    assert results == {files[0]: True, files[1]: True, files[2]: False}
+
+    # Uploading a subset of files leaves the others in place
+    files[0].write_text("changed\n")
+    assert all(r.ok for r in stage.upload_many(files[:1]))
+    results = {r.file: r.ok for r in stage.verify_many(files)}
+    assert results == {files[0]: True, files[1]: True, files[2]: False}
+
+    # Single files can be snapshotted too
+    stage.snapshot_file(files[2])
+    assert all(r.ok for r in stage.verify_many(files))
+
+    # Verifying several files only fetches from the remote once
+    git = stage.git
+    fetches = []
+
+    def counting_git(*args, **kwargs):
+        if args[0] == "fetch":
+            fetches.append(args)
+        return git(*args, **kwargs)
+
+    monkeypatch.setattr(stage, "git", counting_git)
+    assert all(r.ok for r in stage.verify_many(files[:2], jobs=4))
+    assert len(fetches) == 1
+
+
+def test_git_snapshot_partial(tmp_path: Path, remote: str):
+    big = tmp_path / "big.txt"
+    big.write_text("big\n" * 1000)
+    stage = GitStage("big", False, remote, working_directory=tmp_path / "big")
+    stage(big)
+    assert stage.snapshot()
+    blob = _git(tmp_path / "remote.git", "rev-parse", f"main:{stage.repo_path(big)}")
+
+    # Snapshotting another stage from a fresh clone shouldn't fetch the blobs of
+    # files under other prefixes
+    small = tmp_path / "small.txt"
+    small.write_text("small\n")
+    stage = GitStage("small", False, remote, working_directory=tmp_path / "small")
+    stage(small)
+    assert stage.snapshot()
+    objects = _git(
+        stage.checkout, "rev-list", "--objects", "--missing=print", "origin/main"
+    )
+    assert f"?{blob.strip()}" in objects.splitlines()
+
+
+def test_git_plan(tmp_path: Path, remote: str):
+    files = [tmp_path / f"{n}.txt" for n in range(2)]
+    for n, file in enumerate(files):
+        file.write_text(f"{n}\n" * (n + 1))
+    stage = GitStage("plan", False, remote, working_directory=tmp_path / "snap")
+    stage(*files)
+    assert stage.snapshot()
+    assert stage.throughput("upload") is not None
+
+    # The sizes are known before anything is checked out, without fetching blobs
+    restore = GitStage(
+        "restore", True, remote, prefix="plan", working_directory=tmp_path / "restore"
+    )
+    restore(*files)
+    assert [restore.transfer_size(file) for file in files] == [2, 4]
+    assert not restore.checkout_file(files[0]).exists()
+    restore.prepare_restore()
+    assert restore.throughput("download") is not None
@@ -0,0 +1,53 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from snakemake_staging.locking import LeaseLock
+
+
+def test_lock_exclusive(tmp_path: Path):
+    path = tmp_path / "file.lock"
+    active = []
+    overlaps = []
+
+    def worker():
+        with LeaseLock(path, poll=0.01):
+            active.append(1)
+            overlaps.append(len(active))
+            time.sleep(0.02)
+            active.pop()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [1] * 8
+    assert not path.exists()
+
+
+def test_lock_timeout(tmp_path: Path):
+    path = tmp_path / "file.lock"
+    with LeaseLock(path):
+        with pytest.raises(TimeoutError):
+            LeaseLock(path, poll=0.01).acquire(timeout=0.05)
+
+
+def test_lock_stale_takeover(tmp_path: Path):
+    path = tmp_path / "file.lock"
+    dead = LeaseLock(path, lease=1.0)
+    dead.acquire()
+    old = time.time() - 10
+    os.utime(path, (old, old))
+
+    lock = LeaseLock(path, lease=1.0, poll=0.01)
+    lock.acquire(timeout=1.0)
+    assert path.read_text() == lock.token
+
+    # The dead process shouldn't remove the lock that was taken over
+    dead.release()
+    assert path.exists()
+    lock.release()
+    assert not path.exists()
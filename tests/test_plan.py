@@ -0,0 +1,67 @@
+import json
+from pathlib import Path
+
+import pytest
+from snakemake_staging.cli import main
+from snakemake_staging.plan import plan
+from snakemake_staging.stages import NoOpStage
+from snakemake_staging.utils import cwd, path_to_identifier
+
+
+def test_plan_snapshot(tmp_path: Path):
+    stage = NoOpStage("stage", False, working_directory=tmp_path / "staging")
+    a = tmp_path / "a.txt"
+    b = tmp_path / "b.txt"
+    a.write_text("test\n")
+    b.write_text("another test\n")
+    stage(a, b)
+
+    # Mark "b.txt" as already snapshotted
+    staged = stage.directory / path_to_identifier(b)
+    staged.parent.mkdir(parents=True)
+    staged.write_text("another test\n")
+
+    (result,) = plan()
+    assert result.direction == "upload"
+    assert len(result.files) == 2
+    assert len(result.transfer_files) == 1
+    assert result.transfer_bytes == 5
+    assert result.cached_bytes == 13
+    assert result.duration is None
+
+
+def test_plan_restore_throughput(tmp_path: Path):
+    stage = NoOpStage("stage", True, working_directory=tmp_path / "staging")
+    a = tmp_path / "a.txt"
+    stage(a)
+    staged = stage.directory / path_to_identifier(a)
+    staged.parent.mkdir(parents=True)
+    staged.write_text("0123456789")
+
+    stage.record_transfer("download", 100, 2.0)
+    stage.record_transfer("download", 300, 2.0)
+    stage.record_transfer("upload", 1, 100.0)
+    assert stage.throughput("download") == 100.0
+
+    (result,) = plan()
+    assert result.direction == "download"
+    assert result.transfer_bytes == 10
+    assert result.duration == pytest.approx(0.1)
+
+    # Once the file exists, it is no longer transferred
+    a.write_text("0123456789")
+    (result,) = plan()
+    assert result.transfer_bytes == 0
+    assert result.cached_bytes == 10
+    assert result.duration == 0.0
+
+
+def test_plan_cli(capsys: pytest.CaptureFixture[str]):
+    with cwd("tests/projects/zenodo-restore"):
+        main(["plan", "--config", "restore=True", "--json", "--throughput", "2"])
+    (result,) = json.loads(capsys.readouterr().out)
+    assert result["name"] == "stage"
+    assert result["direction"] == "download"
+    assert result["transfer_files"] == 1
+    assert result["transfer_bytes"] == 5
+    assert result["duration"] == 2.5
@@ -0,0 +1,27 @@
+import shutil
+from pathlib import Path
+
+import pytest
+from snakemake_staging.cli import main
+from snakemake_staging.testing import _exec_snakemake
+from snakemake_staging.utils import cwd
+
+
+def test_restore_cli(tmp_path: Path):
+    shutil.copytree("tests/projects/noop-restore", tmp_path, dirs_exist_ok=True)
+    main(["restore", "-d", str(tmp_path), "-q", "--config", "restore=True"])
+    assert (tmp_path / "output" / "a.txt").read_text() == "test\n"
+
+    # Snakemake shouldn't have anything left to do after the restore
+    with cwd(tmp_path):
+        result = _exec_snakemake(
+            "snakemake", "-n", "output/a.txt", "--config", "restore=True"
+        )
+    assert "Nothing to be done" in result.stdout + result.stderr
+
+
+def test_restore_cli_requires_restore(tmp_path: Path):
+    shutil.copytree("tests/projects/noop-restore", tmp_path, dirs_exist_ok=True)
+    with pytest.raises(SystemExit):
+        main(["restore", "-d", str(tmp_path), "-q"])
+    assert not (tmp_path / "output" / "a.txt").exists()
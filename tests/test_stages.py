@@ -0,0 +1,54 @@
+import threading
+from pathlib import Path
+
+import pytest
+from snakemake_staging.stages import NoOpStage, map_files
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_map_files(jobs: int):
+    def func(file):
+        if file == "bad":
+            raise ValueError(file)
+
+    results = {r.file: r for r in map_files(func, ["a", "bad", "b"], jobs=jobs)}
+    assert set(results) == {"a", "bad", "b"}
+    assert results["a"].ok and results["b"].ok
+    assert isinstance(results["bad"].error, ValueError)
+
+
+def test_bulk_transfers(tmp_path: Path):
+    files = [tmp_path / f"{n}.txt" for n in range(3)]
+    for n, file in enumerate(files):
+        file.write_text(f"{n}\n")
+
+    stage = NoOpStage("stage", False, working_directory=tmp_path / "staging")
+    stage(*files)
+    assert all(r.ok for r in stage.upload_many(files))
+    assert all(r.ok for r in stage.verify_many(files))
+
+    files[0].write_text("changed\n")
+    results = {r.file: r for r in stage.verify_many(files)}
+    assert not results[files[0]].ok
+    assert results[files[1]].ok
+
+    for file in files:
+        file.unlink()
+    assert all(r.ok for r in stage.download_many(files))
+    assert [f.read_text() for f in files] == ["0\n", "1\n", "2\n"]
+
+    # Errors are reported in the results rather than raised
+    missing = tmp_path / "missing.txt"
+    (result,) = stage.download_many([missing])
+    assert not result.ok
+
+
+def test_bulk_transfers_jobs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    files = [tmp_path / f"{n}.txt" for n in range(4)]
+    stage = NoOpStage("stage", True, working_directory=tmp_path / "staging")
+    stage(*files)
+
+    # All the downloads can only finish if they run at the same time
+    barrier = threading.Barrier(len(files), timeout=5)
+    monkeypatch.setattr(stage, "restore_file", lambda _: barrier.wait())
+    assert all(r.ok for r in stage.download_many(files, jobs=len(files)))
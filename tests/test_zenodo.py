@@ -1,9 +1,42 @@
+import gzip
+import json
 import os
+import shutil
+import threading
+from pathlib import Path
 
 import pytest
+import requests
+from snakemake_staging.restore import restore
 from snakemake_staging.testing import run_snakemake
+from snakemake_staging.utils import cwd, path_to_identifier
+from snakemake_staging.zenodo import (
+    ZenodoStage,
+    find_file,
+    partition_files,
+    record_id_from_doi,
+)
 
-from tests.zenodo_mock import ZenodoMock
+from tests.zenodo_mock import (
+    DEPOSITIONS,
+    DOWNLOADS,
+    RECORD_REQUESTS,
+    RECORDS,
+    ZenodoMock,
+)
+
+
+def _publish(stage: ZenodoStage) -> None:
+    # Run the same steps as the snapshot rules in zenodo.smk
+    stage.working_directory.mkdir(parents=True, exist_ok=True)
+    stage.create_draft(stage.draft_info_file)
+    upload_info_files = []
+    for file in stage.files.values():
+        upload_info_file = stage.upload_info_file(file)
+        upload_info_file.parent.mkdir(parents=True, exist_ok=True)
+        stage.upload_file(stage.draft_info_file, file, upload_info_file)
+        upload_info_files.append(upload_info_file)
+    stage.publish_draft(stage.draft_info_file, stage.info_file, *upload_info_files)
 
 
 @pytest.fixture(scope="session")
@@ -14,12 +47,14 @@ def server():
     server.stop()
 
 
-def test_zenodo_snapshot(server):
+@pytest.mark.parametrize("sharded", [False, True])
+def test_zenodo_snapshot(server, sharded):
     run_snakemake(
         "tests/projects/zenodo-snapshot",
         "staging__upload",
         "--config",
         f"zenodo_mock_url={server.url}/api",
+        f"sharded={sharded}",
         env=dict(os.environ, ZENODO_TOKEN="test"),
     )
 
@@ -31,3 +66,482 @@ def test_zenodo_restore():
         "--config",
         "restore=True",
     )
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_zenodo_compression(server, tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+
+    stage = ZenodoStage(
+        f"stage-{compression}",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+        compression=compression,
+    )
+    text = tmp_path / "text.csv"
+    text.write_text("a,b,c\n" + "1,2,3\n" * 10_000)
+    noise = tmp_path / "noise.bin"
+    noise.write_bytes(os.urandom(50_000))
+    stage(text, noise)
+
+    # Planned uploads should account for compression
+    assert stage.transfer_size(text) < text.stat().st_size / 5
+    assert stage.transfer_size(noise) == 50_000
+
+    _publish(stage)
+
+    # Only the compressible file should be compressed
+    with open(stage.info_file) as f:
+        info = json.load(f)
+    manifest = info["snakemake_staging"]["files"]
+    codecs = {entry["size"]: entry["codec"] for entry in manifest.values()}
+    assert codecs == {text.stat().st_size: compression, 50_000: None}
+    text_info, _ = find_file(info, text)
+    assert text_info is not None
+    assert text_info["filename"].endswith(stage.codec.suffix)
+    assert text_info["filesize"] < text.stat().st_size / 5
+
+    # Restoring should decompress the files
+    expected = {file: Path(file).read_bytes() for file in stage.files.values()}
+    for file in stage.files.values():
+        Path(file).unlink()
+        stage.download_file(stage.info_file, file)
+        assert Path(file).read_bytes() == expected[file]
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_zenodo_compressed_outputs(server, tmp_path, compression):
+    stage = ZenodoStage(
+        f"stage-gz-{compression}",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+        compression=compression,
+    )
+    file = tmp_path / "data.csv.gz"
+    file.write_bytes(gzip.compress(b"a,b,c\n" * 1000))
+    expected = file.read_bytes()
+    stage(file)
+    _publish(stage)
+
+    # Staged files that are already compressed are restored as is, including
+    # from older info files without a manifest
+    file.unlink()
+    stage.download_file(stage.info_file, file)
+    assert file.read_bytes() == expected
+    with open(stage.info_file) as f:
+        info = json.load(f)
+    del info["snakemake_staging"]
+    with open(stage.info_file, "w") as f:
+        json.dump(info, f)
+    file.unlink()
+    stage.download_file(stage.info_file, file)
+    assert file.read_bytes() == expected
+
+
+def test_zenodo_info_file_restore(server, tmp_path):
+    stage = ZenodoStage(
+        "stage-info",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+    )
+    files = [tmp_path / "output" / f"{n}.txt" for n in range(5)]
+    for n, file in enumerate(files):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_text(f"{n}\n")
+    stage(*files)
+
+    _publish(stage)
+    shutil.rmtree(tmp_path / "output")
+
+    restored = restore(
+        [
+            ZenodoStage.from_info_file(
+                stage.info_file, name="stage-info-restore", working_directory=tmp_path
+            )
+        ],
+        progress=False,
+    )
+    assert len(restored) == 5
+    for n, file in enumerate(files):
+        assert file.read_text() == f"{n}\n"
+
+
+def test_zenodo_single_flight(server, tmp_path):
+    stage = ZenodoStage(
+        "stage-single-flight",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+    )
+    file = tmp_path / "shared" / "a.txt"
+    file.parent.mkdir()
+    file.write_text("shared\n" * 1000)
+    stage(file)
+
+    _publish(stage)
+    file.unlink()
+
+    # Restore the same file from several workers at once
+    errors = []
+
+    def worker():
+        try:
+            stage.download_file(stage.info_file, file)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert file.read_text() == "shared\n" * 1000
+    assert DOWNLOADS[path_to_identifier(file)] == 1
+    assert sorted(p.name for p in file.parent.iterdir()) == ["a.txt"]
+
+
+def test_record_id_from_doi():
+    assert record_id_from_doi("10.5281/zenodo.7897667") == "7897667"
+    assert record_id_from_doi("https://doi.org/10.5072/zenodo.123") == "123"
+    with pytest.raises(ValueError):
+        record_id_from_doi("10.1000/xyz")
+
+
+def test_zenodo_doi_restore(server, tmp_path):
+    stage = ZenodoStage(
+        "stage-doi",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+    )
+    file = tmp_path / "a.txt"
+    file.write_text("doi\n")
+    stage(file)
+    _publish(stage)
+    file.unlink()
+    with open(stage.info_file) as f:
+        doi = json.load(f)["doi"]
+    record_id = record_id_from_doi(doi)
+
+    stage = ZenodoStage(
+        "stage-doi-restore",
+        True,
+        url=f"{server.url}/api",
+        working_directory=tmp_path / "restore",
+        doi=doi,
+        metadata_max_age=0,
+    )
+    stage(file)
+    stage.working_directory.mkdir(parents=True)
+    ok = RECORD_REQUESTS[record_id, 200]
+    not_modified = RECORD_REQUESTS[record_id, 304]
+
+    # The first fetch downloads the metadata and later ones only revalidate it
+    stage.fetch_info()
+    assert RECORD_REQUESTS[record_id, 200] == ok + 1
+    mtime = stage.info_file.stat().st_mtime
+    stage.fetch_info()
+    assert RECORD_REQUESTS[record_id, 304] == not_modified + 1
+    assert stage.info_file.stat().st_mtime == mtime
+
+    # Within the max age, the cache is used without any requests
+    stage.metadata_max_age = 300
+    stage.fetch_info()
+    assert RECORD_REQUESTS[record_id, 200] == ok + 1
+    assert RECORD_REQUESTS[record_id, 304] == not_modified + 1
+
+    stage.restore_file(file)
+    assert file.read_text() == "doi\n"
+
+
+def test_zenodo_doi_restore_compressed(server, tmp_path):
+    stage = ZenodoStage(
+        "stage-doi-gzip",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+        compression="gzip",
+    )
+    file = tmp_path / "a.csv"
+    file.write_text("a,b,c\n" * 1000)
+    expected = file.read_text()
+    stage(file)
+    _publish(stage)
+    file.unlink()
+    with open(stage.info_file) as f:
+        doi = json.load(f)["doi"]
+
+    # The manifest is uploaded with the record, so a DOI restore knows how the
+    # file was compressed and can verify the decompressed data
+    stage = ZenodoStage(
+        "stage-doi-gzip-restore",
+        True,
+        url=f"{server.url}/api",
+        working_directory=tmp_path / "restore",
+        doi=doi,
+    )
+    stage(file)
+    stage.working_directory.mkdir(parents=True)
+    stage.prepare_restore()
+    file_info, manifest = find_file(json.loads(stage.info_file.read_text()), file)
+    assert file_info is not None
+    assert manifest["codec"] == "gzip"
+    stage.restore_file(file)
+    assert file.read_text() == expected
+    assert stage.verify_file(file)
+
+
+def test_zenodo_doi_project(server, tmp_path):
+    stage = ZenodoStage(
+        "stage-doi-project",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+        compression="gzip",
+    )
+    with cwd(tmp_path):
+        file = Path("output/a.txt")
+        file.parent.mkdir()
+        file.write_text("restored from a DOI\n")
+        stage(file)
+        _publish(stage)
+    with open(stage.info_file) as f:
+        doi = json.load(f)["doi"]
+
+    # The record metadata is fetched by a rule rather than when parsing
+    run_snakemake(
+        "tests/projects/zenodo-doi-restore",
+        "output/a.txt",
+        "--config",
+        "restore=True",
+        f"doi={doi}",
+        f"zenodo_mock_url={server.url}/api",
+    )
+
+
+def test_zenodo_refresh_info(tmp_path, monkeypatch):
+    stage = ZenodoStage(
+        "stage-offline",
+        True,
+        working_directory=tmp_path,
+        doi="10.5281/zenodo.1234",
+    )
+
+    def offline(*args, **kwargs):
+        raise requests.ConnectionError("offline")
+
+    monkeypatch.setattr(stage, "request", offline)
+
+    # Without a cached copy there's nothing to revalidate, so this shouldn't try
+    # to reach Zenodo at all
+    stage.refresh_info()
+    assert not stage.info_file.exists()
+
+    # Failures to revalidate a cached copy only warn
+    stage.info_file.write_text(json.dumps({"doi": "10.5281/zenodo.1234"}))
+    with pytest.warns(UserWarning):
+        stage.refresh_info()
+
+
+def test_zenodo_bulk_transfers(server, tmp_path):
+    stage = ZenodoStage(
+        "stage-bulk",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+        compression="gzip",
+    )
+    files = [tmp_path / f"{n}.txt" for n in range(8)]
+    for n, file in enumerate(files):
+        file.write_text(f"{n}\n" * (1 + 1000 * (n % 2)))
+    stage(*files)
+
+    stage.working_directory.mkdir(parents=True)
+    stage.create_draft(stage.draft_info_file)
+    assert all(r.ok for r in stage.upload_many(files, jobs=4))
+    assert all(r.ok for r in stage.verify_many(files))
+    stage.publish_draft(
+        stage.draft_info_file,
+        stage.info_file,
+        *[stage.upload_info_file(file) for file in files],
+    )
+
+    expected = [file.read_text() for file in files]
+    for file in files:
+        file.unlink()
+    stage.restore = True
+    assert all(r.ok for r in stage.download_many(files, jobs=4))
+    assert [file.read_text() for file in files] == expected
+    assert all(r.ok for r in stage.verify_many(files))
+
+
+def test_partition_files():
+    files = ["a", "b", "c", "d", "e"]
+    sizes = [5, 1, 4, 2, 3]
+    shards = partition_files(files, sizes, max_files=2, max_bytes=6)
+    assert sorted(map(sorted, shards)) == [["a", "b"], ["c", "d"], ["e"]]
+    assert partition_files(files, sizes, max_files=5, max_bytes=100) == [files]
+    with pytest.raises(ValueError):
+        partition_files(files, sizes, max_files=5, max_bytes=4)
+
+
+def test_zenodo_sharded(server, tmp_path):
+    stage = ZenodoStage(
+        "stage-sharded",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+        compression="gzip",
+        max_shard_files=2,
+    )
+    files = [tmp_path / f"{n}.txt" for n in range(5)]
+    for n, file in enumerate(files):
+        file.write_text(f"{n}\n" * 1000)
+    stage(*files)
+    assert stage.is_sharded
+
+    stage.publish_shards(stage.info_file)
+    with open(stage.info_file) as f:
+        info = json.load(f)
+    shards = info["snakemake_staging"]["shards"]
+    assert len(shards) == 3
+    assert [f["filename"] for f in info["files"]] == ["snakemake-staging-index.json"]
+    assert len(info["snakemake_staging"]["files"]) == len(files)
+
+    # Restore from the published index record by DOI, which needs to resolve the
+    # shards from the index file
+    expected = [file.read_text() for file in files]
+    for file in files:
+        file.unlink()
+    stage = ZenodoStage(
+        "stage-sharded-restore",
+        True,
+        url=f"{server.url}/api",
+        working_directory=tmp_path / "restore",
+        doi=info["doi"],
+    )
+    stage(*files)
+    stage.working_directory.mkdir(parents=True)
+    stage.fetch_info()
+    assert all(r.ok for r in stage.download_many(files, jobs=4))
+    assert [file.read_text() for file in files] == expected
+
+    # Resolving the shards keeps the metadata lock alive between requests: one
+    # for the index, and one for each shard and its manifest
+    calls = []
+    stage.resolve_record(RECORDS[stage.record_id], refresh=lambda: calls.append(None))
+    assert len(calls) == 1 + 2 * len(shards)
+    assert all(r.ok for r in stage.verify_many(files))
+
+
+def test_zenodo_sharded_retry(server, tmp_path, monkeypatch):
+    stage = ZenodoStage(
+        "stage-sharded-retry",
+        False,
+        url=f"{server.url}/api",
+        token="test",
+        working_directory=tmp_path / "staging",
+        max_shard_files=2,
+        jobs=2,
+    )
+    files = [tmp_path / f"{n}.txt" for n in range(5)]
+    for n, file in enumerate(files):
+        file.write_text(f"{n}\n")
+    stage(*files)
+
+    upload_file = stage.upload_file
+    publish_draft = stage.publish_draft
+    uploads = []
+    failing = {files[3]}
+
+    def flaky_upload(draft_info_file, file, upload_info_file):
+        if Path(file) in failing:
+            raise RuntimeError("upload failed")
+        uploads.append(Path(file))
+        upload_file(draft_info_file, file, upload_info_file)
+
+    def restored(file):
+        file.unlink()
+        stage.download_file(stage.info_file, file)
+        return file.read_text()
+
+    # If any upload fails, nothing should be published
+    monkeypatch.setattr(stage, "upload_file", flaky_upload)
+    depositions = len(DEPOSITIONS)
+    records = len(RECORDS)
+    with pytest.raises(RuntimeError):
+        stage.publish_shards(stage.info_file)
+    assert len(DEPOSITIONS) == depositions + 3
+    assert len(RECORDS) == records
+
+    # Rerunning reuses the drafts, only uploading the file that failed and
+    # creating the index deposition
+    failing.clear()
+    uploads.clear()
+    stage.publish_shards(stage.info_file)
+    assert uploads == [files[3]]
+    assert len(DEPOSITIONS) == depositions + 4
+    assert len(RECORDS) == records + 4
+
+    # If a file changes after some shards were published, nothing is reused
+    def flaky_publish(draft_info_file, info_file, *upload_info_files):
+        if Path(info_file).name == "shard-1.json":
+            raise RuntimeError("publish failed")
+        publish_draft(draft_info_file, info_file, *upload_info_files)
+
+    monkeypatch.setattr(stage, "publish_draft", flaky_publish)
+    files[0].write_text("a\n")
+    with pytest.raises(RuntimeError):
+        stage.publish_shards(stage.info_file)
+    files[0].write_text("b\n")
+    monkeypatch.setattr(stage, "publish_draft", publish_draft)
+    stage.publish_shards(stage.info_file)
+    assert restored(files[0]) == "b\n"
+
+    # If publishing is interrupted after the index is published, a rerun just
+    # finishes writing the info file
+    def crashing_publish(draft_info_file, info_file, *upload_info_files):
+        publish_draft(draft_info_file, info_file, *upload_info_files)
+        if Path(info_file).name == "index.json":
+            raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(stage, "publish_draft", crashing_publish)
+    files[1].write_text("c\n")
+    with pytest.raises(RuntimeError):
+        stage.publish_shards(stage.info_file)
+    depositions = len(DEPOSITIONS)
+    records = len(RECORDS)
+    monkeypatch.setattr(stage, "publish_draft", publish_draft)
+    stage.publish_shards(stage.info_file)
+    assert len(DEPOSITIONS) == depositions
+    assert len(RECORDS) == records
+    assert restored(files[1]) == "c\n"
+
+    # If the files change before a rerun, the old drafts are discarded
+    failing.add(files[3])
+    files[2].write_text("d\n")
+    depositions = len(DEPOSITIONS)
+    records = len(RECORDS)
+    with pytest.raises(RuntimeError):
+        stage.publish_shards(stage.info_file)
+    files[4].unlink()
+    del stage.files[path_to_identifier(files[4])]
+    failing.clear()
+    stage.publish_shards(stage.info_file)
+    assert len(DEPOSITIONS) == depositions + 3
+    assert len(RECORDS) == records + 3
+    assert restored(files[2]) == "d\n"
@@ -1,42 +1,125 @@
+import hashlib
 import time
 import uuid
+from collections import Counter
+from itertools import count
 from threading import Thread
 
 import requests
-from flask import Blueprint, Flask, request, session, url_for
+from flask import Blueprint, Flask, abort, jsonify, request, url_for
 from werkzeug.serving import make_server
 
 api = Blueprint("api", __name__)
+records = Blueprint("records", __name__)
+
+# Uploaded file contents for each deposition, shared between sessions so that
+# files can be downloaded, and a count of downloads for each file
+DEPOSITIONS = {}
+DOWNLOADS = Counter()
+_ids = count(1234)
+
+# Published records, served in the format of the records API, and a count of the
+# responses for each record by status code
+RECORDS = {}
+RECORD_REQUESTS = Counter()
 
 
 @api.route("/deposit/depositions", methods=["POST"])
 def create():
     assert request.headers["Authorization"] == "Bearer test"
+    dep_id = str(next(_ids))
+    DEPOSITIONS[dep_id] = {}
     return {
-        "id": 1234,
+        "id": dep_id,
         "links": {
-            "bucket": url_for("api.bucket", _external=True),
+            "bucket": url_for("api.bucket", dep_id=dep_id, _external=True),
         },
     }
 
 
-@api.route("/bucket", methods=["PUT"], defaults={"filename": ""})
-@api.route("/bucket/<filename>", methods=["PUT"])
-def bucket(filename: str):
+@api.route("/deposit/depositions/<dep_id>", methods=["DELETE"])
+def delete(dep_id: str):
+    assert request.headers["Authorization"] == "Bearer test"
+    if dep_id in RECORDS:
+        abort(403)
+    del DEPOSITIONS[dep_id]
+    return "", 204
+
+
+@api.route("/bucket/<dep_id>", methods=["PUT"], defaults={"filename": ""})
+@api.route("/bucket/<dep_id>/<filename>", methods=["PUT"])
+def bucket(dep_id: str, filename: str):
     assert request.headers["Authorization"] == "Bearer test"
-    session["files"] = session.get("files", []) + [filename]
-    return {}
+    data = request.get_data()
+    DEPOSITIONS[dep_id][filename] = data
+    return {
+        "key": filename,
+        "size": len(data),
+        "checksum": f"md5:{hashlib.md5(data).hexdigest()}",
+    }
 
 
 @api.route("/deposit/depositions/<dep_id>/actions/publish", methods=["POST"])
 def publish(dep_id: str):
     assert request.headers["Authorization"] == "Bearer test"
+    files = DEPOSITIONS[dep_id]
+    RECORDS[dep_id] = {
+        "id": dep_id,
+        "doi": f"10.5281/zenodo.{dep_id}",
+        "files": [
+            {
+                "key": f,
+                "size": len(data),
+                "checksum": f"md5:{hashlib.md5(data).hexdigest()}",
+            }
+            for f, data in files.items()
+        ],
+        "links": {
+            "self_html": url_for("records.record", dep_id=dep_id, _external=True),
+        },
+    }
     return {
+        "id": dep_id,
+        "record_id": dep_id,
         "doi": f"10.5281/zenodo.{dep_id}",
-        "files": [{"filename": f} for f in session.get("files", [])],
+        "files": [
+            {
+                "filename": f,
+                "filesize": len(data),
+                "checksum": hashlib.md5(data).hexdigest(),
+            }
+            for f, data in files.items()
+        ],
+        "links": {
+            "record_html": url_for("records.record", dep_id=dep_id, _external=True),
+        },
     }
 
 
+@api.route("/records/<dep_id>", methods=["GET"])
+def api_record(dep_id: str):
+    if dep_id not in RECORDS:
+        abort(404)
+    response = jsonify(RECORDS[dep_id])
+    response.add_etag()
+    response.make_conditional(request)
+    RECORD_REQUESTS[dep_id, response.status_code] += 1
+    return response
+
+
+@records.route("/<dep_id>", methods=["GET"])
+def record(dep_id: str):
+    return {"id": dep_id}
+
+
+@records.route("/<dep_id>/files/<filename>", methods=["GET"])
+def download(dep_id: str, filename: str):
+    if filename not in DEPOSITIONS.get(dep_id, {}):
+        abort(404)
+    DOWNLOADS[filename] += 1
+    return DEPOSITIONS[dep_id][filename]
+
+
 class ZenodoMock:
     def __init__(self, port=5050):
         self.port = port
@@ -52,6 +135,7 @@ class ZenodoMock:
             return "True"
 
         self.app.register_blueprint(api, url_prefix="/api")
+        self.app.register_blueprint(records, url_prefix="/record")
 
     def start(self):
         self.thread = Thread(target=self.server.serve_forever, daemon=True)